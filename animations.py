@@ -1,7 +1,9 @@
 import math
 import random
 import numpy as np
-from util import rot_matrix
+import beat
+from particles import Particles
+from fields import FieldCache, MIN_DIST2
 
 # Frequency at which animations are updated
 UPDATE_RATE = 30
@@ -9,23 +11,94 @@ UPDATE_RATE = 30
 # Time between each update (in seconds)
 UPDATE_TIME = 1 / UPDATE_RATE
 
+# Brightness below which a decaying animation is considered black,
+# since it rounds to zero on 8-bit LEDs
+BLACK_LEVEL = 1 / 255
+
+# Brightness below which a LED stays off once the output applies the
+# default gamma correction (2.2), since it packs to zero
+VISIBLE_LEVEL = (0.5 / 255) ** (1 / 2.2)
+
+# Largest fraction of the structure's bounding box a light can reach for
+# it to be rendered locally. Writing scattered LEDs costs several times
+# more per LED than writing all of them in order.
+LOCAL_FRACTION = 0.05
+
 # Colors
-GREEN = np.array([0,1,0])
-BLUE = np.array([0,0,1])
-RED = np.array([1,0,0])
-YELLOW = np.array([1,1,0])
-CYAN = np.array([0,1,1])
-MAGENTA = np.array([1,0,1])
+# Note: these are float32 so that writing them into the pixel
+# buffers doesn't involve any float64 temporaries
+WHITE = np.array([1,1,1], dtype=np.float32)
+GREEN = np.array([0,1,0], dtype=np.float32)
+BLUE = np.array([0,0,1], dtype=np.float32)
+RED = np.array([1,0,0], dtype=np.float32)
+YELLOW = np.array([1,1,0], dtype=np.float32)
+CYAN = np.array([0,1,1], dtype=np.float32)
+MAGENTA = np.array([1,0,1], dtype=np.float32)
 
 class Animation:
     """
     Base class for all animations
+
+    Animations render into a caller-owned float32 output buffer with the
+    same shape as struct.pixels. The buffer must be written in place and
+    never replaced, since output code may hold a reference to it.
     """
 
-    def __init__(self, struct):
+    def __init__(self, struct, out=None):
         # 3D structure on which the animation will be mapped
         self.struct = struct
 
+        # Output buffer the animation renders into (struct.pixels by default)
+        self.out = struct.pixels if out is None else out
+        assert self.out.dtype == np.float32
+        assert self.out.shape == struct.pixels.shape
+
+        # Pool of preallocated scratch buffers, indexed by name
+        self._scratch = {}
+
+        # Cache of derived per-LED fields (distances, falloffs, masks)
+        self.fields = FieldCache(struct)
+
+        # LEDs lit by the last local light field, or None if unknown
+        self._lit = None
+
+        # Position and radius of the last query of a local light field,
+        # and the LEDs it returned, sorted by distance, with their
+        # squared distances and falloff
+        self._local_pos = None
+        self._local_radius = 0
+        self._local_leds = None
+        self._local_dist2 = None
+        self._local_falloff = None
+
+
+        # Incremented every time the output buffer changes, so that the
+        # output code can skip frames which are the same as the last one
+        self.generation = 0
+
+        # Generation at which the output buffer was last cleared to black
+        self._cleared_gen = -1
+
+        # Read-only audio features, shared by all animations
+        # (indexed with beat.FEAT_BASS, beat.FEAT_RMS, etc.)
+        self.features = beat.features.view
+
+    def scratch(self, name, shape=None):
+        """
+        Get a named float32 scratch buffer, allocated on first use.
+        By default, the buffer holds one value per LED.
+        """
+
+        shape = self.out.shape[:-1] if shape is None else tuple(shape)
+
+        buf = self._scratch.get(name)
+
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape, dtype=np.float32)
+            self._scratch[name] = buf
+
+        return buf
+
     def pulse(self, t):
         """
         Called when a beat or notable audio change occurs
@@ -35,18 +108,140 @@ class Animation:
 
     def update(self, t):
         """
-        Called at a regular interval to update the animation
+        Called at a regular interval to update the animation.
+        Must write the new frame into self.out in place.
+        May return False if the frame is unchanged since the last update.
         """
         raise NotImplementedError
 
+    def render(self, t):
+        """
+        Update the animation and track changes to the output buffer.
+        Returns True if the frame changed.
+        """
+
+        changed = self.update(t) is not False
+        if changed:
+            self.generation += 1
+        return changed
+
+    def clear(self):
+        """
+        Clear the output buffer to black. Returns False if it is
+        already black, so that update can return the result.
+        """
+
+        # Nothing was rendered since the last clear
+        if self._cleared_gen == self.generation:
+            return False
+
+        self.out[:] = 0
+        self._lit = None
+        self._cleared_gen = self.generation + 1
+        return True
+
+    def light_field(self, pos, brightness, color, cached=False):
+        """
+        Write the light from a point source into the output buffer,
+        with a brightness that falls off with the squared distance.
+        LEDs the light doesn't visibly reach are left black.
+        Returns False if the output buffer didn't change.
+        If cached is true, the falloff field is kept in the field cache,
+        which is worth it for lights that stay in place between frames.
+        """
+
+        # Beyond this radius, the light packs to zero on the LEDs
+        radius = math.sqrt(max(brightness, 0) / VISIBLE_LEVEL)
+
+        # Volume of the sphere the light reaches
+        volume = 4 / 3 * math.pi * radius ** 3
+
+        if volume < LOCAL_FRACTION * self.struct.index.volume:
+            return self.local_light_field(pos, brightness, color, radius)
+
+        self._lit = None
+
+        if cached:
+            falloff = self.fields.falloff(pos)
+        else:
+            falloff = self.dist2_field(pos)
+            np.maximum(falloff, MIN_DIST2, out=falloff)
+            np.divide(1, falloff, out=falloff)
+
+        # Note: we loop over the color channels because broadcasting a
+        # (3,) vector against the buffers makes NumPy allocate temporaries
+        for k in range(3):
+            np.multiply(falloff, brightness * color[k], out=self.out[..., k])
+
+        return True
+
+    def local_light_field(self, pos, brightness, color, radius):
+        """
+        Write the light from a point source into the LEDs within some
+        radius only, so the cost scales with the number of LEDs lit.
+        Returns False if no LEDs were lit by this frame or the last one.
+        """
+
+        # Query the LEDs around the light when it moves or grows. While
+        # it stays in place and fades, the LEDs it reaches are a prefix
+        # of the last query, sorted by distance.
+        pos_key = tuple(float(x) for x in pos)
+        if pos_key != self._local_pos or radius > self._local_radius:
+            leds, dist2 = self.struct.index.query_radius(pos, radius, return_dist2=True)
+            order = np.argsort(dist2)
+            self._local_pos = pos_key
+            self._local_radius = radius
+            self._local_leds = leds[order]
+            self._local_dist2 = dist2[order]
+            falloff = np.maximum(self._local_dist2, MIN_DIST2)
+            self._local_falloff = np.divide(1, falloff, out=falloff)
+
+        num_lit = int(np.searchsorted(self._local_dist2, radius * radius, side='right'))
+        leds = self._local_leds[:num_lit]
+
+        if num_lit == 0 and self._lit is not None and len(self._lit) == 0:
+            return False
+
+        # Turn off the LEDs lit by the last frame
+        if self._lit is None:
+            self.out[:] = 0
+        else:
+            self.out[self._lit] = 0
+        self._lit = leds
+
+        lit = self.scratch('lit', self._local_falloff.shape)[:num_lit]
+        for k in range(3):
+            np.multiply(self._local_falloff[:num_lit], brightness * color[k], out=lit)
+            self.out[leds, k] = lit
+
+        return True
+
+    def dist2_field(self, pos):
+        """
+        Compute the squared distance from a point to every LED.
+        The result is written into the 'dist2' scratch buffer.
+        """
+
+        poss = self.struct.poss
+        delta = self.scratch('delta')
+        dist2 = self.scratch('dist2')
+
+        dist2[:] = 0
+        for k in range(3):
+            np.subtract(poss[..., k], pos[k], out=delta)
+            np.multiply(delta, delta, out=delta)
+            np.add(dist2, delta, out=dist2)
+
+        return dist2
+
 class TestSequence(Animation):
     """
     Test sequence. This is used to help us connect the
     LED strips in the correct order on the physical cube.
     """
 
-    def __init__(self, struct):
-        super().__init__(struct)
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
 
         self.edge_idx = 0
 
@@ -64,16 +259,17 @@ class TestSequence(Animation):
             self.edge_idx = (self.edge_idx + 1) % len(self.struct.edges)
             self.led_idx = 0
 
-        self.struct.pixels[:, :] = 0
-        self.struct.pixels[self.edge_idx, self.led_idx, 0] = 1
+        self.out[:] = 0
+        led_start = self.struct.edges[self.edge_idx].led_start
+        self.out[led_start + self.led_idx, 0] = 1
 
 class BasicStrobe(Animation):
     """
     Basic strobe light that pulses to the beat
     """
 
-    def __init__(self, struct):
-        super().__init__(struct)
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
 
         self.pulse_time = 0
 
@@ -83,76 +279,72 @@ class BasicStrobe(Animation):
     def update(self, t):
         dt = t - self.pulse_time
         brightness = math.pow(0.94, 100 * dt)
-        color = np.array([1, 1, 1]) * brightness
-        self.struct.pixels[:, :] = color
+        if brightness < BLACK_LEVEL:
+            return self.clear()
+        self.out[:] = brightness
 
 class PosiStrobe(Animation):
     """
     Simple positional strobe effect
     """
 
-    def __init__(self, struct):
-        super().__init__(struct)
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
 
         self.pulse_time = 0
-        self.pos = np.array([0, 0, 0])
+        self.pos = np.zeros(3, dtype=np.float32)
 
     def pulse(self, t):
         self.pulse_time = t
 
         # TODO: method to compute min/max cube extents or
         # sample point around structure
-        self.pos = np.random.uniform(
-            np.array([-0.5, -0.5, -0.5]),
-            np.array([0.5, 0.5, 0.5])
-        )
+        self.pos[:] = np.random.uniform(-0.5, 0.5, size=3)
 
     def update(self, t):
-        dist = self.struct.poss - self.pos
-        dist = np.linalg.norm(dist, axis=-1)
-        dist = np.expand_dims(dist, -1)
-
         dt = t - self.pulse_time
         brightness = math.pow(0.94, 100 * dt)
-        color = np.array([1, 0, 0]) * brightness / (dist*dist)
-
-        self.struct.pixels = color
+        return self.light_field(self.pos, brightness, RED, cached=True)
 
 class ColoredPosiStrobe(Animation):
     """
     Colored positional strobe effect
     """
-    def __init__(self, struct):
-        super().__init__(struct)
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
 
         self.pulse_time = 0
-        self.pos = np.random.uniform(
-            np.array([-0.5, -0.5, -0.5]),
-            np.array([0.5, 0.5, 0.5])
-        )
+        self.color = BLUE
+
+        # Current level of the flash, which decays a bit faster at
+        # every frame since the last beat
+        self.level = 0
 
     def pulse(self, t):
         self.pulse_time = t
         colors = [BLUE, CYAN, MAGENTA]
-        color = colors[np.random.randint(0,3)]
-        self.struct.pixels[:,:] = color
+        self.color = colors[np.random.randint(0,3)]
+        self.level = 1
 
     def update(self, t):
-        dist = self.struct.poss - self.pos
-        dist = np.linalg.norm(dist, axis=-1)
-        dist = np.expand_dims(dist, -1)
         dt = t - self.pulse_time
         brightness = math.pow(0.94, 100 * dt)
 
-        self.struct.pixels[:,:] *= brightness
+        self.level *= brightness
+        if self.level < BLACK_LEVEL:
+            return self.clear()
+
+        # The whole structure flashes the same color
+        for k in range(3):
+            self.out[..., k] = self.level * self.color[k]
 
 class EdgeStrobe(Animation):
     """
     Randomly flash one edge of the cube at a time
     """
 
-    def __init__(self, struct):
-        super().__init__(struct)
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
 
         self.cur_edge = 0
         self.pulse_time = 0
@@ -160,21 +352,22 @@ class EdgeStrobe(Animation):
     def pulse(self, t):
         self.cur_edge = np.random.randint(0, self.struct.num_edges)
         self.pulse_time = t
-        self.struct.pixels[:, :, :] = 0
+        self.out[:] = 0
 
     def update(self, t):
         dt = t - self.pulse_time
         brightness = math.pow(0.94, 100 * dt)
-        color = np.array([1, 1, 1]) * brightness
-        self.struct.pixels[self.cur_edge, :] = color
+        if brightness < BLACK_LEVEL:
+            return self.clear()
+        self.struct.edge_view(self.out, self.cur_edge)[:] = brightness
 
 class RotoStrobe(Animation):
     """
     Light source that rotates around the origin
     """
 
-    def __init__(self, struct):
-        super().__init__(struct)
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
 
         self.pulse_time = 0
         #self.pos = np.array([0, 0, 0])
@@ -187,52 +380,179 @@ class RotoStrobe(Animation):
         # Rotation direction
         self.rot_dir = True
 
+        # Current position of the light
+        self.light_pos = np.zeros(3, dtype=np.float32)
+
     def pulse(self, t):
         self.pulse_time = t
         self.rot_dir = not self.rot_dir
 
     def update(self, t):
-        m = rot_matrix([0, 1, 0], self.rot_angle)
-        light_pos = np.matmul(np.array([self.light_dist, 0, 0]), m)
+        # Rotate the light around the y axis
+        light_pos = self.light_pos
+        light_pos[0] = self.light_dist * math.cos(self.rot_angle)
+        light_pos[2] = self.light_dist * math.sin(self.rot_angle)
         self.rot_angle += self.rot_speed if self.rot_dir else -self.rot_speed
 
-        dist = self.struct.poss - light_pos
-        dist = np.linalg.norm(dist, axis=-1)
-        dist = np.expand_dims(dist, -1)
-
         dt = t - self.pulse_time
         #brightness = math.pow(0.94, 100 * dt)
         brightness = 1
-        color = np.array([1, 1, 1]) * brightness / (dist*dist)
+        self.light_field(light_pos, brightness, WHITE)
+
+class BandGlow(Animation):
+    """
+    Continuous glow following the audio bands. The bass lights the
+    bottom of the structure in red, the mids the middle in green and
+    the highs the top in blue.
+    """
+
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
+
+        # Height of each LED, normalized between 0 and 1
+        y = struct.poss[..., 1]
+        h = (y - y.min()) / max(1e-6, y.max() - y.min())
+
+        # Weight of each band for each LED
+        self.weights = np.stack(
+            [1 - h, 1 - np.abs(2 * h - 1), h]
+        ).astype(np.float32)
+
+        # Feature bus update count at the last frame rendered
+        self.features_count = None
+
+    def update(self, t):
+        # The frame only changes when the features do
+        if beat.features.count == self.features_count:
+            return False
+        self.features_count = beat.features.count
+
+        bands = self.features[beat.FEAT_BASS:beat.FEAT_HIGH+1]
+        for k in range(3):
+            np.multiply(self.weights[k], bands[k], out=self.out[..., k])
+
+class ShootingStars(Animation):
+    """
+    Bursts of shooting stars leaving random vertices on each beat, and
+    taking a random direction at every vertex they go through.
+    """
+
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
+
+        self.particles = Particles(struct)
+
+        # Number of stars spawned on each beat
+        self.burst_size = max(8, struct.num_edges // 2)
+
+        self.last_t = None
+
+    def pulse(self, t):
+        n = self.burst_size
+        verts = np.random.randint(0, len(self.struct.verts), n)
+        speed = np.random.uniform(1.5, 3, n)
+        color = random.choice([WHITE, CYAN, YELLOW, MAGENTA])
+        self.particles.spawn_at_verts(verts, speed, color, life=2)
+
+    def update(self, t):
+        dt = 0 if self.last_t is None else t - self.last_t
+        self.last_t = t
 
-        self.struct.pixels = color
+        # Leave fading trails behind the stars
+        self.out *= 0.75
+        self.particles.step(dt)
+        self.particles.splat(self.out)
 
 class BloodDrops(Animation):
     """
-    Blood drops
+    Blood drops falling from the top vertices on each beat, speeding
+    up as they fall and leaving slowly fading trails. A drop branching
+    at a vertex only survives on an edge that doesn't go up.
     """
 
-    def __init__(self, struct):
-        super().__init__(struct)
-        self.pulse_time = 0
-        red = np.array([1,0,0])
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
+
+        self.particles = Particles(struct)
+
+        # Vertices the drops fall from
+        heights = struct.vert_poss[:, 1]
+        self.top_verts = np.flatnonzero(heights >= heights.max() - 1e-3)
+
+        # Acceleration of the drops, in units per second squared
+        self.gravity = 1.5
+
+        self.last_t = None
 
     def pulse(self, t):
-        pass
+        n = 2 * len(self.top_verts)
+        verts = np.random.choice(self.top_verts, n)
+        speed = np.random.uniform(0.2, 0.5, n)
+        self.particles.spawn_at_verts(verts, speed, RED, life=4)
+
+    def keep_falling(self, idx, new_edge, direction):
+        rise = self.struct.edge_dirs[new_edge, 1] * direction
+        return rise <= 0.1
 
     def update(self, t):
-        pass
+        dt = 0 if self.last_t is None else t - self.last_t
+        self.last_t = t
+
+        p = self.particles
+        idx = np.flatnonzero(p.alive)
+        p.speed[idx] += np.sign(p.speed[idx]) * self.gravity * dt
+
+        self.out *= 0.9
+        p.step(dt, keep=self.keep_falling)
+        p.splat(self.out)
+
+class EdgeDots(Animation):
+    """
+    Move a dot along every edge at once. The dots reverse
+    direction on each beat.
+    """
+
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
+
+        # Speed of the dots, in edge lengths per second
+        self.speed = 0.8
+
+        # Position of the dot along each edge, from 0 to 1
+        self.dot_pos = np.random.uniform(0, 1, struct.num_edges).astype(np.float32)
+
+        self.direction = 1
+        self.last_t = None
+
+    def pulse(self, t):
+        self.direction = -self.direction
+
+    def update(self, t):
+        dt = 0 if self.last_t is None else t - self.last_t
+        self.last_t = t
+
+        self.dot_pos += self.direction * self.speed * dt
+        np.mod(self.dot_pos, 1, out=self.dot_pos)
+
+        # Gather the dot position of each LED's edge, and light
+        # the LEDs close to it
+        dist = self.scratch('dist')
+        np.take(self.dot_pos, self.struct.led_edges, out=dist, mode='clip')
+        np.subtract(dist, self.struct.led_fracs, out=dist)
+        np.abs(dist, out=dist)
+        np.multiply(dist, -12, out=dist)
+        np.add(dist, 1, out=dist)
+        np.maximum(dist, 0, out=dist)
+
+        for k in range(3):
+            np.multiply(dist, CYAN[k], out=self.out[:, k])
 
-# IDEA: move a dot along every edge at once
-    
 # IDEA: very fast random flashing of edges after each beat
 
 # IDEA: selectively flash a subset of the edges in white or red
 # Ideally there should be some symmetry in the edge patterns
 
 # Other animation ideas
-# - Shooting star, random direction change at vertex
-# - Blood drops
 # - Standing waves to the beat
 
 def reg_animations():
@@ -259,9 +579,9 @@ def reg_animations():
 
     return animations
 
-def random_animation(struct):
+def random_animation(struct, out=None):
     anim_class = random.choice(animations)
-    return anim_class(struct)
+    return anim_class(struct, out)
 
 # List of animations we can pick from
 animations = reg_animations()
@@ -0,0 +1,199 @@
+import time
+import threading
+import numpy as np
+from stats import stats
+
+class SampleRing:
+    """
+    Single-producer single-consumer ring buffer of audio samples.
+
+    The producer only writes the write counter and the consumer only
+    writes the read counter, so neither side ever needs to take a lock.
+    """
+
+    def __init__(self, capacity):
+        self.buf = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+
+        # Total number of samples written/read so far
+        self.write_count = 0
+        self.read_count = 0
+
+        # Write count and capture time of the last sample written,
+        # updated together so the consumer sees a consistent pair
+        self.stamp = (0, 0)
+
+        # Number of blocks dropped because the ring was full
+        self.overflows = 0
+
+    @property
+    def depth(self):
+        """
+        Number of samples waiting to be read
+        """
+        return self.write_count - self.read_count
+
+    def push(self, samples, t):
+        """
+        Copy a block of samples into the ring (producer side).
+        The time t is the capture time of the last sample.
+        """
+
+        n = len(samples)
+
+        if self.depth + n > self.capacity:
+            self.overflows += 1
+            return False
+
+        start = self.write_count % self.capacity
+        end = start + n
+
+        if end <= self.capacity:
+            self.buf[start:end] = samples
+        else:
+            split = self.capacity - start
+            self.buf[start:] = samples[:split]
+            self.buf[:end-self.capacity] = samples[split:]
+
+        self.stamp = (self.write_count + n, t)
+        self.write_count += n
+        return True
+
+    def pop(self, out, max_count):
+        """
+        Copy available samples into out (consumer side), without going
+        past the sample with index max_count. Returns the number of
+        samples copied.
+        """
+
+        n = min(max_count - self.read_count, len(out))
+        if n <= 0:
+            return 0
+
+        start = self.read_count % self.capacity
+        end = start + n
+
+        if end <= self.capacity:
+            out[:n] = self.buf[start:end]
+        else:
+            split = self.capacity - start
+            out[:split] = self.buf[start:]
+            out[split:n] = self.buf[:end-self.capacity]
+
+        self.read_count += n
+        return n
+
+class AudioInput:
+    """
+    Live audio input. The PortAudio callback only copies samples into a
+    ring buffer, and the analysis runs on a dedicated worker thread.
+    """
+
+    def __init__(self, device=None, block_duration=10, ring_duration=1.0):
+        import sounddevice as sd
+
+        self.device = device
+        self.samplerate = sd.query_devices(device, 'input')['default_samplerate']
+        self.blocksize = int(self.samplerate * block_duration / 1000)
+
+        self.ring = SampleRing(int(self.samplerate * ring_duration))
+
+        # Buffer the worker thread reads samples into
+        self.chunk = np.zeros(self.ring.capacity, dtype=np.float32)
+
+        # Input overflows reported by PortAudio
+        self.input_overflows = 0
+
+        # Number of times the worker found no audio for over two blocks
+        self.underflows = 0
+
+        # Maximum number of samples waiting in the ring
+        self.max_depth = 0
+
+        self.stream = None
+        self.thread = None
+        self.running = False
+
+    def start(self, process):
+        """
+        Start capturing audio. The process function is called on the
+        worker thread with each chunk of samples and the capture time
+        of the last sample in the chunk.
+        """
+
+        import sounddevice as sd
+
+        self.process = process
+        self.running = True
+
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+        self.stream = sd.InputStream(
+            device=self.device,
+            channels=1,
+            callback=self._callback,
+            blocksize=self.blocksize,
+            samplerate=self.samplerate
+        )
+        self.stream.start()
+
+    def stop(self):
+        """
+        Stop capturing audio and wait for the worker thread
+        """
+
+        if self.stream:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        """
+        Get the audio pipeline counters
+        """
+
+        return {
+            'input_overflows': self.input_overflows,
+            'ring_overflows': self.ring.overflows,
+            'underflows': self.underflows,
+            'depth': self.ring.depth,
+            'max_depth': self.max_depth,
+        }
+
+    def _callback(self, indata, frames, time_info, status):
+        # Note: this runs on the PortAudio thread and must stay minimal
+        if status.input_overflow:
+            self.input_overflows += 1
+        self.ring.push(indata[:, 0], time.monotonic())
+
+    def _worker(self):
+        block_time = self.blocksize / self.samplerate
+        last_data = time.monotonic()
+
+        while self.running:
+            self.max_depth = max(self.max_depth, self.ring.depth)
+
+            count, t = self.ring.stamp
+            n = self.ring.pop(self.chunk, count)
+
+            if n == 0:
+                now = time.monotonic()
+                if now - last_data > 2 * block_time:
+                    self.underflows += 1
+                    last_data = now
+                time.sleep(block_time / 2)
+                continue
+
+            last_data = time.monotonic()
+
+            # Time of the last sample read, relative to the stamp
+            t_end = t - (count - self.ring.read_count) / self.samplerate
+            start = time.perf_counter()
+            self.process(self.chunk[:n], t_end)
+            stats.record('audio.process', time.perf_counter() - start)
@@ -0,0 +1,430 @@
+import math
+import queue
+import numpy as np
+
+# Layout of the audio feature vector
+FEAT_BASS = 0
+FEAT_MID = 1
+FEAT_HIGH = 2
+FEAT_RMS = 3
+FEAT_FLUX = 4
+FEAT_ENVELOPE = 5
+NUM_FEATURES = 6
+
+# Frequency range (in Hz) of the bass, mid and high bands
+BANDS = [(20, 250), (250, 2000), (2000, 8000)]
+
+class FeatureBus:
+    """
+    Shared buffer holding the latest audio features, updated every hop
+    by the audio analysis. Animations read the features through a
+    read-only view, so they never need to compute an FFT themselves.
+    """
+
+    def __init__(self):
+        # Feature values, written by the audio analysis only
+        self.values = np.zeros(NUM_FEATURES, dtype=np.float32)
+
+        # Read-only view of the values, for animations
+        self.view = self.values.view()
+        self.view.flags.writeable = False
+
+        # Time of the last update, and number of updates so far
+        self.time = 0
+        self.count = 0
+
+# Feature bus shared by the audio analysis and all the animations
+features = FeatureBus()
+
+def make_filterbank(samplerate, fft_size, bands):
+    """
+    Build a matrix which averages the power spectrum over each band
+    """
+
+    freqs = np.fft.rfftfreq(fft_size, 1 / samplerate)
+    fb = np.zeros((len(bands), len(freqs)), dtype=np.float32)
+
+    for band_idx, (low, high) in enumerate(bands):
+        mask = (freqs >= low) & (freqs < high)
+        fb[band_idx, mask] = 1 / max(1, mask.sum())
+
+    return fb
+
+class BeatDetector:
+    """
+    Streaming onset detector for live audio.
+
+    Audio is pushed in blocks of any size. Samples accumulate in a ring
+    buffer and every hop_size samples an rFFT is computed over the last
+    fft_size samples. The weighted low-frequency energy is compared
+    against its moving average and variance, and a timestamped pulse is
+    emitted when it rises above the threshold.
+    """
+
+    def __init__(
+        self,
+        samplerate,
+        on_pulse=None,
+        fft_size=2048,
+        hop_size=512,
+        max_freq=170,
+        gamma=0.995,
+        min_interval=0.1,
+        bus=features
+    ):
+        assert fft_size % hop_size == 0
+
+        self.samplerate = samplerate
+        self.fft_size = fft_size
+        self.hop_size = hop_size
+
+        # Function called with the time of each detected onset
+        self.on_pulse = on_pulse
+
+        # Decay factor for the moving energy statistics
+        self.gamma = gamma
+
+        # Minimum time between two pulses (in seconds)
+        self.min_interval = min_interval
+
+        # Precomputed analysis window
+        self.window = np.hanning(fft_size).astype(np.float32)
+
+        # Precomputed weights for the low frequency bins, favoring
+        # the lowest frequencies where the kick drum is
+        freqs = np.fft.rfftfreq(fft_size, 1 / samplerate)
+        max_bin = max(1, int(np.searchsorted(freqs, max_freq)))
+        self.weights = 1 / (1 + np.arange(max_bin, dtype=np.float32))
+
+        # Ring buffer holding the last fft_size samples. Every sample is
+        # written twice so that the latest window is always contiguous.
+        self.ring = np.zeros(2 * fft_size, dtype=np.float32)
+        self.ring_pos = 0
+
+        # Number of samples received since the last hop
+        self.hop_fill = 0
+
+        # Preallocated buffers for the analysis
+        self.frame = np.zeros(fft_size, dtype=np.float32)
+        self.mag = np.zeros(fft_size // 2 + 1, dtype=np.float32)
+
+        # Moving statistics of the onset energy
+        self.moving_avg = 0
+        self.moving_var = 1
+
+        # True while the energy is above the threshold
+        self.above = False
+
+        # Time of the last pulse emitted
+        self.last_pulse = -np.inf
+
+        # Number of pulses emitted so far
+        self.num_pulses = 0
+
+        # Feature bus the audio features are published to
+        self.bus = bus
+
+        # Precomputed filterbank for the band energies
+        self.filterbank = make_filterbank(samplerate, fft_size, BANDS)
+
+        # Preallocated buffers for the features
+        self.power = np.zeros_like(self.mag)
+        self.prev_mag = np.zeros_like(self.mag)
+        self.flux_buf = np.zeros_like(self.mag)
+        self.bands = np.zeros(len(BANDS), dtype=np.float32)
+
+        # Slowly decaying peaks of the band energies and spectral flux,
+        # used to normalize the features between 0 and 1
+        self.peaks = np.full(len(BANDS) + 1, 1e-9, dtype=np.float32)
+        self.peak_decay = 0.999
+
+        # Attack and release factors of the envelope follower
+        self.attack = 0.5
+        self.release = 0.05
+
+    def process(self, samples, t):
+        """
+        Push a block of mono samples. The time t (in seconds)
+        is the time at which the last sample was captured.
+        """
+
+        n = len(samples)
+        pos = 0
+
+        while pos < n:
+            count = min(n - pos, self.hop_size - self.hop_fill)
+            self._write(samples[pos:pos+count])
+            pos += count
+            self.hop_fill += count
+
+            if self.hop_fill == self.hop_size:
+                self.hop_fill = 0
+                self._analyze(t - (n - pos) / self.samplerate)
+
+    def _write(self, samples):
+        """
+        Write samples into the ring buffer
+        """
+
+        size = self.fft_size
+        n = len(samples)
+        start = self.ring_pos
+        end = start + n
+
+        if end <= size:
+            self.ring[start:end] = samples
+            self.ring[start+size:end+size] = samples
+        else:
+            split = size - start
+            self.ring[start:size] = samples[:split]
+            self.ring[start+size:] = samples[:split]
+            self.ring[:end-size] = samples[split:]
+            self.ring[size:end] = samples[split:]
+
+        self.ring_pos = end % size
+
+    def _analyze(self, t):
+        """
+        Analyze the latest window of samples, ending at time t
+        """
+
+        window = self.ring[self.ring_pos:self.ring_pos+self.fft_size]
+        np.multiply(window, self.window, out=self.frame)
+        np.abs(np.fft.rfft(self.frame), out=self.mag)
+
+        energy = float(np.dot(self.mag[:len(self.weights)], self.weights))
+
+        avg, std = self.moving_avg, self.moving_var ** 0.5
+        self.moving_avg = self.gamma * avg + (1 - self.gamma) * energy
+        self.moving_var = self.gamma * self.moving_var + (1 - self.gamma) * energy ** 2
+
+        above = (energy - avg) / std - 0.5 > 0
+
+        # Pulse on the rising edge of the onset
+        if above and not self.above and t - self.last_pulse >= self.min_interval:
+            self.last_pulse = t
+            self.num_pulses += 1
+            if self.on_pulse:
+                self.on_pulse(t)
+
+        self.above = above
+
+        if self.bus is not None:
+            self._features(window, t)
+
+    def _features(self, window, t):
+        """
+        Compute the audio features and publish them on the bus
+        """
+
+        values = self.bus.values
+        peaks = self.peaks
+
+        # Band energies
+        np.multiply(self.mag, self.mag, out=self.power)
+        np.dot(self.filterbank, self.power, out=self.bands)
+
+        # Positive spectral flux
+        np.subtract(self.mag, self.prev_mag, out=self.flux_buf)
+        np.maximum(self.flux_buf, 0, out=self.flux_buf)
+        flux = self.flux_buf.sum()
+        self.prev_mag[:] = self.mag
+
+        # RMS of the latest hop of samples
+        hop = window[-self.hop_size:]
+        rms = math.sqrt(float(np.dot(hop, hop)) / self.hop_size)
+
+        peaks *= self.peak_decay
+        np.maximum(peaks[:-1], self.bands, out=peaks[:-1])
+        peaks[-1] = max(peaks[-1], flux)
+
+        np.divide(self.bands, peaks[:-1], out=values[FEAT_BASS:FEAT_HIGH+1])
+        values[FEAT_RMS] = rms
+        values[FEAT_FLUX] = flux / peaks[-1]
+
+        # Envelope follower, fast attack and slow release
+        env = values[FEAT_ENVELOPE]
+        k = self.attack if rms > env else self.release
+        values[FEAT_ENVELOPE] = env + k * (rms - env)
+
+        self.bus.time = t
+        self.bus.count += 1
+
+class TempoTracker:
+    """
+    Beat grid tracker. Detected onsets are fitted to a tempo and phase,
+    and pulses are scheduled at the predicted beat times instead of when
+    the onsets are detected, which hides the detection latency.
+
+    The tempo is found by scoring candidate beat periods by how well the
+    recent onsets line up on a grid with that period (the magnitude of
+    the mean of exp(2*pi*i*t/period)), with a mild preference for tempos
+    close to 120 BPM to resolve half/double tempo ambiguities.
+    """
+
+    def __init__(
+        self,
+        on_pulse=None,
+        input_latency=0,
+        output_latency=0,
+        min_bpm=80,
+        max_bpm=180,
+        num_periods=200,
+        history=16,
+        min_lock=0.5
+    ):
+        # Function called with the time of each scheduled pulse
+        self.on_pulse = on_pulse
+
+        # Delay between a beat and its detection (in seconds)
+        self.input_latency = input_latency
+
+        # Delay between a pulse and the LEDs lighting up (in seconds)
+        self.output_latency = output_latency
+
+        # Candidate beat periods, in seconds
+        self.periods = 60 / np.linspace(max_bpm, min_bpm, num_periods)
+
+        # Prior favoring tempos close to 120 BPM
+        log_ratio = np.log2(self.periods / 0.5)
+        self.prior = np.exp(-0.5 * (log_ratio / 0.5) ** 2)
+
+        # Ring buffer of the most recent onset times
+        self.onsets = np.zeros(history)
+        self.num_onsets = 0
+
+        # Minimum grid alignment score for the tempo to be trusted
+        self.min_lock = min_lock
+
+        # Current beat period (seconds) and time of a beat on the grid
+        self.period = None
+        self.phase = 0
+
+        # How well the onsets line up with the grid, between 0 and 1
+        self.lock = 0
+
+        # Time of the next scheduled beat
+        self.next_beat = np.inf
+
+        # Time of the last pulse emitted
+        self.last_pulse = -np.inf
+
+        # Onsets signaled from the audio thread, processed by poll
+        # so that all the state changes and pulses happen on the
+        # frame thread, concurrently with nothing else
+        self.pending = queue.SimpleQueue()
+
+    @property
+    def bpm(self):
+        return 60 / self.period if self.period else 0
+
+    def push_onset(self, t):
+        """
+        Signal a detected onset from another thread (eg: the audio
+        worker). It is processed by the next call to poll.
+        """
+
+        self.pending.put(t)
+
+    def onset(self, t):
+        """
+        Signal a detected onset. The time t is the detection time.
+        """
+
+        t -= self.input_latency
+        self.onsets[self.num_onsets % len(self.onsets)] = t
+        self.num_onsets += 1
+
+        if self.num_onsets >= 4:
+            self._fit(t)
+
+        # Without a reliable beat grid, pass the onsets through
+        if self.next_beat == np.inf:
+            self.last_pulse = t
+            if self.on_pulse:
+                self.on_pulse(t + self.input_latency)
+
+    def _fit(self, now):
+        """
+        Fit the beat grid to the recent onsets, where now is the time
+        of the latest onset
+        """
+
+        count = min(self.num_onsets, len(self.onsets))
+        times = self.onsets[:count]
+
+        # Weigh recent onsets more, so the grid follows tempo changes
+        weights = np.exp((times - now) / 4)
+
+        # Phase of every onset relative to every candidate period
+        angles = (2 * np.pi) * times[:, np.newaxis] / self.periods
+        resultant = np.dot(weights, np.exp(1j * angles)) / weights.sum()
+
+        scores = np.abs(resultant) * self.prior
+        best = int(np.argmax(scores))
+
+        self.period = self.periods[best]
+        self.phase = np.angle(resultant[best]) / (2 * np.pi) * self.period
+        self.lock = float(np.abs(resultant[best]))
+
+        if self.lock < self.min_lock:
+            self.next_beat = np.inf
+            return
+
+        # Schedule the next beat on the grid, skipping any beat too
+        # close to the last pulse so the same beat doesn't fire twice.
+        # If the beat matching the latest onset hasn't been pulsed
+        # yet, it is scheduled right away.
+        after = max(now, self.last_pulse + self.period) - self.period / 2
+        k = math.ceil((after - self.phase) / self.period)
+        self.next_beat = self.phase + k * self.period
+
+    def poll(self, t):
+        """
+        Called at every frame. Emits a pulse if a predicted beat is due,
+        accounting for the output latency.
+        """
+
+        while True:
+            try:
+                self.onset(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        if t + self.output_latency < self.next_beat:
+            return False
+
+        self.last_pulse = self.next_beat
+        self.next_beat += self.period
+
+        # Stop predicting beats if no onsets were detected for a while
+        last_onset = self.onsets[(self.num_onsets - 1) % len(self.onsets)]
+        if self.next_beat - last_onset > 8 * self.period:
+            self.next_beat = np.inf
+
+        if self.on_pulse:
+            self.on_pulse(t)
+
+        return True
+
+def beat_track(duration, t0=0):
+    """
+    Generate synthetic beat times over some duration. The tempo slowly
+    varies and some beats are doubled, like in the simulator.
+    """
+
+    beats = []
+    t = t0
+
+    while t < t0 + duration:
+        beats.append(t)
+
+        bpm = 120 + 30 * math.sin(t / 40)
+        secs_per_beat = 60 / bpm
+
+        if len(beats) % 5 < 2:
+            t += secs_per_beat / 2
+        else:
+            t += secs_per_beat
+
+    return beats
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Headless benchmark for the animations. Every registered animation is
+driven with a simulated clock and a synthetic beat track, and the time
+spent in update() and pulse() is compared against the frame budget.
+"""
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import structure
+import animations
+from beat import beat_track
+
+def lattice(n, leds_per_edge=60):
+    """
+    Build a synthetic cubic lattice structure with n vertices per side,
+    used to benchmark animations on structures larger than the cube
+    """
+
+    struct = structure.Structure(leds_per_edge)
+
+    for x in range(n):
+        for y in range(n):
+            for z in range(n):
+                struct.add_vertex([x, y, z])
+
+    def idx(x, y, z):
+        return (x * n + y) * n + z
+
+    for x in range(n):
+        for y in range(n):
+            for z in range(n):
+                if x + 1 < n:
+                    struct.add_edge(idx(x, y, z), idx(x + 1, y, z))
+                if y + 1 < n:
+                    struct.add_edge(idx(x, y, z), idx(x, y + 1, z))
+                if z + 1 < n:
+                    struct.add_edge(idx(x, y, z), idx(x, y, z + 1))
+
+    # Center the lattice on the origin and fit it in [-0.5, 0.5]
+    struct.scale(1 / (n - 1))
+    for vert in struct.verts:
+        vert.pos -= 0.5
+
+    struct.finalize()
+    return struct
+
+def run_anim(anim_class, struct, num_frames, measure_allocs=False):
+    """
+    Drive one animation for a number of frames using a simulated clock.
+    Returns the update times, pulse times, allocated bytes per frame,
+    and the number of frames that were unchanged.
+    """
+
+    anim = anim_class(struct)
+
+    duration = num_frames * animations.UPDATE_TIME
+    beats = beat_track(duration)
+    beat_idx = 0
+
+    update_times = np.zeros(num_frames)
+    pulse_times = []
+    alloc_bytes = np.zeros(num_frames)
+    num_unchanged = 0
+
+    if measure_allocs:
+        tracemalloc.start()
+
+    for frame_idx in range(num_frames):
+        t = frame_idx * animations.UPDATE_TIME
+
+        if measure_allocs:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        while beat_idx < len(beats) and beats[beat_idx] <= t:
+            start = time.perf_counter()
+            anim.pulse(t)
+            pulse_times.append(time.perf_counter() - start)
+            beat_idx += 1
+
+        start = time.perf_counter()
+        if not anim.render(t):
+            num_unchanged += 1
+        update_times[frame_idx] = time.perf_counter() - start
+
+        if measure_allocs:
+            alloc_bytes[frame_idx] = tracemalloc.get_traced_memory()[1] - base
+
+    if measure_allocs:
+        tracemalloc.stop()
+
+    return update_times, np.array(pulse_times), alloc_bytes, num_unchanged
+
+def percentiles(times):
+    """
+    Compute the p50, p99 and max of a list of times, in milliseconds
+    """
+
+    if len(times) == 0:
+        return 0, 0, 0
+
+    p50, p99 = np.percentile(times, [50, 99])
+    return 1000 * p50, 1000 * p99, 1000 * np.max(times)
+
+def bench_struct(name, struct, anim_classes, num_frames):
+    """
+    Benchmark a list of animation classes on a given structure.
+    Returns True if all animations fit in the frame budget.
+    """
+
+    budget_ms = 1000 * animations.UPDATE_TIME
+
+    print('{} ({} edges, {} LEDs), budget {:.1f} ms'.format(
+        name, struct.num_edges, struct.num_leds, budget_ms
+    ))
+    print('  {:<20} {:>24} {:>24} {:>12} {:>10}  {}'.format(
+        'animation',
+        'update p50/p99/max (ms)',
+        'pulse p50/p99/max (ms)',
+        'alloc/frame',
+        'unchanged',
+        'status'
+    ))
+
+    all_ok = True
+
+    for anim_class in anim_classes:
+        update_times, pulse_times, _, num_unchanged = run_anim(anim_class, struct, num_frames)
+
+        # Allocations are measured in a separate pass because
+        # tracing allocations slows everything down
+        _, _, alloc_bytes, _ = run_anim(
+            anim_class, struct, num_frames, measure_allocs=True
+        )
+
+        u50, u99, umax = percentiles(update_times)
+        p50, p99, pmax = percentiles(pulse_times)
+
+        # Worst case frame has both a pulse and an update
+        ok = u99 + p99 <= budget_ms
+        all_ok = all_ok and ok
+
+        print('  {:<20} {:>8.3f}{:>8.3f}{:>8.3f} {:>8.3f}{:>8.3f}{:>8.3f} {:>10.1f}KB {:>9.0f}%  {}'.format(
+            anim_class.__name__,
+            u50, u99, umax,
+            p50, p99, pmax,
+            np.median(alloc_bytes) / 1024,
+            100 * num_unchanged / num_frames,
+            'ok' if ok else 'FAIL'
+        ))
+
+    print()
+    return all_ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--anim", type=str, default='', help='benchmark a specific animation')
+    parser.add_argument("--frames", type=int, default=600, help='number of frames to simulate')
+    parser.add_argument("--lattice", type=int, nargs='*', default=[3, 4], help='sizes of the synthetic lattices to test')
+    args = parser.parse_args()
+
+    if args.anim:
+        anim_classes = [getattr(animations, args.anim)]
+    else:
+        anim_classes = animations.reg_animations()
+
+    structs = [('cube', structure.cube)]
+    for n in args.lattice:
+        structs.append(('lattice{}'.format(n), lattice(n)))
+
+    all_ok = True
+    for name, struct in structs:
+        all_ok = bench_struct(name, struct, anim_classes, args.frames) and all_ok
+
+    if not all_ok:
+        parser.exit(1, 'Some animations exceed the frame budget\n')
@@ -0,0 +1,199 @@
+"""
+Delta encoding of packed LED frames. Each frame is compared with the
+last frame sent, and only the spans of LEDs that changed are sent,
+unless most of the frame changed, in which case a full keyframe is
+sent. Keyframes are also sent periodically, so receivers recover from
+lost or corrupted frames.
+"""
+
+import time
+import struct
+import numpy as np
+
+KEYFRAME = 0
+DELTA = 1
+
+# Message header: kind, sequence number, number of LEDs, number of spans
+HEADER_FORMAT = '<BxHII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+class DeltaFrame:
+    """
+    Encoded frame. A keyframe has one span covering all the LEDs.
+    The data is the RGB bytes of the LEDs in the spans, concatenated.
+    """
+
+    def __init__(self, kind, seq, num_leds, spans, data):
+        self.kind = kind
+        self.seq = seq
+        self.num_leds = num_leds
+
+        # (num_spans, 2) array of start and end LED indices
+        self.spans = spans
+
+        # (num_span_leds, 3) uint8 array
+        self.data = data
+
+    @property
+    def num_bytes(self):
+        return HEADER_SIZE + 8 * len(self.spans) + self.data.nbytes
+
+    def to_bytes(self):
+        header = struct.pack(HEADER_FORMAT, self.kind, self.seq, self.num_leds, len(self.spans))
+        return header + self.spans.astype('<u4').tobytes() + self.data.tobytes()
+
+    @staticmethod
+    def from_bytes(buf):
+        kind, seq, num_leds, num_spans = struct.unpack_from(HEADER_FORMAT, buf)
+        spans = np.frombuffer(buf, dtype='<u4', count=2*num_spans, offset=HEADER_SIZE)
+        data_offset = HEADER_SIZE + spans.nbytes
+        data = np.frombuffer(buf, dtype=np.uint8, offset=data_offset).reshape(-1, 3)
+        return DeltaFrame(kind, seq, num_leds, spans.reshape(-1, 2).astype(np.intp), data)
+
+def span_indices(spans):
+    """
+    Indices of all the LEDs in a list of spans, without a Python loop
+    """
+
+    starts = spans[:, 0]
+    lengths = spans[:, 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(int(lengths.sum())) + np.repeat(starts - offsets, lengths)
+
+class DeltaEncoder:
+    """
+    Encode packed frames as spans of changed LEDs. The encoded frames
+    reference the encoder's buffers, and are only valid until the
+    next frame is encoded.
+    """
+
+    def __init__(self, num_leds, keyframe_ratio=0.5, refresh_interval=1.0, merge_gap=8):
+        self.num_leds = num_leds
+
+        # Send a keyframe when more than this fraction of the LEDs changed
+        self.keyframe_ratio = keyframe_ratio
+
+        # Send a keyframe at least every refresh_interval seconds. This is
+        # time based, since unchanged frames are usually not encoded at all.
+        self.refresh_interval = refresh_interval
+
+        # Spans separated by this many unchanged LEDs or less are merged,
+        # since each span has some overhead
+        self.merge_gap = merge_gap
+
+        # Last frame sent
+        self.prev = np.zeros((num_leds, 3), dtype=np.uint8)
+
+        self.neq = np.zeros((num_leds, 3), dtype=bool)
+        self.changed = np.zeros(num_leds, dtype=bool)
+
+        self.full_span = np.array([[0, num_leds]], dtype=np.intp)
+
+        self.seq = 0
+
+        # Time of the last keyframe, None to force a keyframe
+        self.keyframe_time = None
+
+        # Bytes sent, and bytes full frames would have taken
+        self.bytes_sent = 0
+        self.bytes_full = 0
+
+    def force_keyframe(self):
+        self.keyframe_time = None
+
+    def refresh_due(self):
+        """
+        Check if a keyframe is due, so that receivers recover from lost
+        frames even when nothing changes. The last frame sent (prev) can
+        then be encoded again, as a keyframe.
+        """
+
+        if self.keyframe_time is None:
+            return False
+        return time.monotonic() - self.keyframe_time >= self.refresh_interval
+
+    def encode(self, packed):
+        """
+        Encode a (num_leds, 3) uint8 frame
+        """
+
+        self.seq = (self.seq + 1) & 0xFFFF
+
+        np.not_equal(packed, self.prev, out=self.neq)
+        np.any(self.neq, axis=1, out=self.changed)
+        idx = np.flatnonzero(self.changed)
+
+        now = time.monotonic()
+
+        keyframe = (
+            self.keyframe_time is None or
+            now - self.keyframe_time >= self.refresh_interval or
+            len(idx) > self.keyframe_ratio * self.num_leds
+        )
+
+        if keyframe:
+            self.keyframe_time = now
+            self.prev[:] = packed
+            frame = DeltaFrame(KEYFRAME, self.seq, self.num_leds, self.full_span, self.prev)
+        else:
+            # Split the changed LEDs where the gaps are too large
+            breaks = np.flatnonzero(np.diff(idx) > self.merge_gap + 1)
+            spans = np.empty((len(breaks) + 1 if len(idx) else 0, 2), dtype=np.intp)
+            if len(idx):
+                spans[0, 0] = idx[0]
+                spans[1:, 0] = idx[breaks + 1]
+                spans[:-1, 1] = idx[breaks] + 1
+                spans[-1, 1] = idx[-1] + 1
+
+            leds = span_indices(spans)
+            data = packed[leds]
+            self.prev[leds] = data
+            frame = DeltaFrame(DELTA, self.seq, self.num_leds, spans, data)
+
+        self.bytes_sent += frame.num_bytes
+        self.bytes_full += HEADER_SIZE + 3 * self.num_leds
+
+        return frame
+
+    def stats(self):
+        return {
+            'bytes_sent': self.bytes_sent,
+            'bytes_full': self.bytes_full,
+            'ratio': self.bytes_sent / max(1, self.bytes_full),
+        }
+
+class DeltaDecoder:
+    """
+    Apply encoded frames to a uint8 frame buffer
+    """
+
+    def __init__(self, num_leds):
+        self.rgb = np.zeros((num_leds, 3), dtype=np.uint8)
+
+        # Sequence number of the last frame applied
+        self.seq = None
+
+        # False after a lost frame, until the next keyframe
+        self.synced = False
+
+        self.num_lost = 0
+
+    def apply(self, frame):
+        """
+        Apply a frame, returns True if the decoded frame is known
+        to be correct
+        """
+
+        if frame.kind == KEYFRAME:
+            self.rgb[:] = frame.data.reshape(self.rgb.shape)
+            self.synced = True
+        else:
+            if self.seq is None:
+                self.synced = False
+            elif frame.seq != (self.seq + 1) & 0xFFFF:
+                self.num_lost += 1
+                self.synced = False
+            self.rgb[span_indices(frame.spans)] = frame.data
+
+        self.seq = frame.seq
+        return self.synced
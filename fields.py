@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import numpy as np
+
+# Squared distance below which LEDs get the full falloff value,
+# so that a point source on top of an LED doesn't divide by zero
+MIN_DIST2 = 1e-4
+
+class FieldCache:
+    """
+    Cache of derived per-LED fields (distance to a point, light falloff,
+    per-edge masks), keyed by the inputs they are computed from. Fields
+    are only recomputed when their inputs change. The cache holds a
+    bounded number of bytes, evicting the least recently used fields,
+    and evicted buffers are reused for new fields of the same shape.
+    """
+
+    def __init__(self, struct, max_bytes=1 << 22):
+        self.struct = struct
+        self.max_bytes = max_bytes
+
+        # Cached fields, from least to most recently used
+        self.fields = OrderedDict()
+        self.num_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute, shape=None):
+        """
+        Get a cached float32 field, computing it if missing. The compute
+        function is called with the buffer to write the field into. The
+        returned array is read-only, and only valid until the next get.
+        """
+
+        buf = self.fields.get(key)
+        if buf is not None:
+            self.fields.move_to_end(key)
+            self.hits += 1
+            return buf
+
+        self.misses += 1
+
+        shape = (self.struct.num_leds,) if shape is None else tuple(shape)
+        buf = self._alloc(shape)
+        buf.flags.writeable = True
+        compute(buf)
+        buf.flags.writeable = False
+
+        self.fields[key] = buf
+        self.num_bytes += buf.nbytes
+
+        # Computing the field may have cached other fields
+        while len(self.fields) > 1 and self.num_bytes > self.max_bytes:
+            _, old = self.fields.popitem(last=False)
+            self.num_bytes -= old.nbytes
+
+        return buf
+
+    def _alloc(self, shape):
+        """
+        Make room for a new field, reusing an evicted buffer if possible
+        """
+
+        nbytes = int(np.prod(shape)) * 4
+        spare = None
+
+        while self.fields and self.num_bytes + nbytes > self.max_bytes:
+            _, old = self.fields.popitem(last=False)
+            self.num_bytes -= old.nbytes
+            if old.shape == shape:
+                spare = old
+
+        if spare is not None:
+            return spare
+        return np.empty(shape, dtype=np.float32)
+
+    def clear(self):
+        self.fields.clear()
+        self.num_bytes = 0
+
+    def dist2(self, pos):
+        """
+        Squared distance from a point to every LED
+        """
+
+        pos = np.asarray(pos, dtype=np.float32)
+
+        def compute(buf):
+            delta = self.struct.poss - pos
+            np.einsum('ij,ij->i', delta, delta, out=buf)
+
+        return self.get(('dist2',) + tuple(pos.tolist()), compute)
+
+    def falloff(self, pos):
+        """
+        Inverse squared distance from a point to every LED, the light
+        received from a point source of unit brightness
+        """
+
+        pos = np.asarray(pos, dtype=np.float32)
+
+        def compute(buf):
+            np.maximum(self.dist2(pos), MIN_DIST2, out=buf)
+            np.divide(1, buf, out=buf)
+
+        return self.get(('falloff',) + tuple(pos.tolist()), compute)
+
+    def edge_mask(self, edges):
+        """
+        Mask with ones on the LEDs of some edges and zeros elsewhere
+        """
+
+        edges = tuple(sorted(int(e) for e in edges))
+
+        def compute(buf):
+            buf[:] = 0
+            for edge_idx in edges:
+                buf[self.struct.edges[edge_idx].leds] = 1
+
+        return self.get(('edge_mask',) + edges, compute)
@@ -1,5 +1,172 @@
 #!/usr/bin/env python3
 
+import time
 import argparse
+import random
 import structure
 import animations
+from mixer import Mixer
+from scheduler import FrameScheduler
+from stats import stats
+from audio import AudioInput
+from beat import BeatDetector, TempoTracker
+import offline
+import show
+from pipeline import RenderProcess
+from output import open_output
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--anim", type=str, default='', help='run a specific animation')
+parser.add_argument("--device", type=str, default=None, help='audio input device (numeric ID or substring)')
+parser.add_argument("--block-duration", type=float, default=10, help='audio block size (milliseconds)')
+parser.add_argument("--input-latency", type=float, default=30, help='delay between a beat and its detection (milliseconds)')
+parser.add_argument("--show", type=str, default='', help='replay a recorded show file')
+parser.add_argument("--track", type=str, default='', help='WAV file to replay the precomputed beat grid of')
+parser.add_argument("--output-latency", type=float, default=10, help='delay between a pulse and the LEDs lighting up (milliseconds)')
+parser.add_argument("--no-skip", action='store_true', help="don't skip frames when falling behind")
+parser.add_argument("--stats", type=str, default='', help="publish timing stats to a file, or to 'unix:' followed by a socket path")
+parser.add_argument("--multiprocess", action='store_true', help='render the animations in a worker process')
+parser.add_argument("--output", type=str, default='', help="LED output, 'ws281x', 'ddp:<address>', 'serial:<device>' or 'mock:' followed by a file path, see output.open_output")
+parser.add_argument("--brightness", type=float, default=1, help='global LED brightness (0 to 1)')
+parser.add_argument("--delta", action='store_true', help='only send the LEDs that changed to network outputs')
+parser.add_argument("--gamma", type=float, default=2.2, help='LED gamma correction exponent')
+parser.add_argument("--stats-interval", type=float, default=2, help='interval between stats updates (seconds)')
+args = parser.parse_args()
+
+if args.device is not None and args.device.isdigit():
+    args.device = int(args.device)
+
+if args.multiprocess:
+    # Render in a worker process, which must be started
+    # before the audio input threads
+    anim = RenderProcess(
+        structure.cube.num_leds,
+        args.anim or random.choice(animations.animations).__name__,
+        args.show
+    )
+    anim.start()
+    stats.add_source('render', anim.stats)
+    stats.add_timing_source(anim.timings)
+else:
+    # All animations are rendered through the mixer, so that we
+    # can crossfade between them
+    anim = Mixer(structure.cube)
+
+    if args.show:
+        anim.add_layer(show.ShowAnimation, show.ShowReader(args.show))
+    elif args.anim:
+        anim.add_layer(getattr(animations, args.anim))
+    else:
+        anim.add_layer(random.choice(animations.animations))
+
+output = None
+if args.output:
+    output = open_output(args.output, structure.cube, args.gamma, args.brightness, args.delta)
+    stats.add_source('output', output.stats)
+
+# Number of pulses sent to the animations so far
+num_pulses = 0
+
+def on_pulse(t):
+    """
+    Forward beats to the active animation
+    """
+    global num_pulses
+    num_pulses += 1
+    anim.pulse(t)
+
+tracker = TempoTracker(
+    on_pulse,
+    input_latency=args.input_latency / 1000,
+    output_latency=args.output_latency / 1000
+)
+
+audio = None
+
+def start_live_audio():
+    """
+    Start live beat detection from the audio input
+    """
+    global audio
+    audio = AudioInput(args.device, args.block_duration)
+    stats.add_source('audio', audio.stats)
+    detector = BeatDetector(audio.samplerate, on_pulse=tracker.push_onset)
+    audio.start(detector.process)
+
+# Replay a precomputed beat grid if a track is given,
+# with live beat detection as a fallback
+if args.track:
+    player = offline.GridPlayer(offline.load_analysis(args.track), on_pulse)
+    player.start(time.monotonic())
+elif args.show:
+    player = None
+else:
+    player = None
+    start_live_audio()
+
+# Number of pulses at the last animation change
+num_beats = 0
+
+def frame(t):
+    """
+    Render one frame
+    """
+    global player
+    global num_beats
+
+    start = time.perf_counter()
+
+    if player:
+        player.poll(t)
+        if player.done:
+            print('Track done, switching to live beat detection')
+            player = None
+            start_live_audio()
+    elif audio:
+        tracker.poll(t)
+
+    if args.multiprocess:
+        # The worker renders the frames, and we output the latest one
+        # straight from shared memory, unless it gets overwritten
+        anim.send_features()
+        latest = anim.frames.begin_read()
+        if output and latest:
+            pixels, generation, token = latest
+            output.push(pixels, generation, lambda: anim.frames.end_read(token))
+    else:
+        anim.render(t)
+        if output:
+            output.push(anim.out, anim.generation)
+
+    # Randomly pick the next animation every 20 beats
+    if num_pulses >= num_beats + 20 and not (args.anim or args.show):
+        num_beats = num_pulses
+        anim_class = random.choice(animations.animations)
+        anim.crossfade(anim_class, 4)
+        print('Next animation:', anim_class.__name__)
+
+    stats.record('frame', time.perf_counter() - start)
+
+scheduler = FrameScheduler(frame, skip=not args.no_skip)
+
+if args.stats:
+    stats.add_source('scheduler', scheduler.stats)
+    stats.start_publisher(args.stats, args.stats_interval)
+
+try:
+    scheduler.run()
+
+except KeyboardInterrupt:
+    pass
+
+finally:
+    print('Frame stats:', scheduler.stats())
+    if output:
+        print('Output stats:', output.stats())
+        output.close()
+    if args.multiprocess:
+        print('Render stats:', anim.stats())
+        anim.stop()
+    if audio:
+        audio.stop()
+        print('Audio stats:', audio.stats())
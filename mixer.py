@@ -0,0 +1,201 @@
+import time
+import numpy as np
+from animations import Animation
+from stats import stats
+
+# Ways a layer can be blended with the layers below it
+BLEND_MODES = ('add', 'max', 'multiply', 'alpha')
+
+class Layer:
+    """
+    Animation rendering into its own buffer, to be blended by the mixer
+    """
+
+    def __init__(self, anim, buf, mode, opacity):
+        assert mode in BLEND_MODES
+
+        self.anim = anim
+        self.buf = buf
+        self.mode = mode
+        self.opacity = opacity
+
+        # Names the timings of this layer are recorded under
+        name = anim.__class__.__name__
+        self.update_key = 'update.' + name
+        self.pulse_key = 'pulse.' + name
+
+class Mixer(Animation):
+    """
+    Compositor running several animations at once. Each animation renders
+    into its own preallocated layer buffer, and the layers are blended in
+    place, bottom to top, into the output buffer.
+    """
+
+    def __init__(self, struct, out=None):
+        super().__init__(struct, out)
+
+        # Layers, from bottom to top
+        self.layers = []
+
+        # Buffers of removed layers, reused for new layers
+        self.free_bufs = []
+
+        # Layer being crossfaded in over the bottom layer
+        self.fade_layer = None
+        self.fade_beats = 0
+        self.fade_count = 0
+
+        # Set when the layers or their blending change, so the
+        # layers are composited even if no layer changed
+        self.layers_changed = True
+
+        # Time of the last pulse and interval between the last two
+        self.pulse_time = None
+        self.beat_interval = 0.5
+
+    def add_layer(self, anim_class, *args, mode='add', opacity=1.0, index=None):
+        """
+        Create an animation rendering into a new layer
+        """
+
+        if self.free_bufs:
+            buf = self.free_bufs.pop()
+            buf[:] = 0
+        else:
+            buf = np.zeros_like(self.out)
+
+        anim = anim_class(self.struct, *args, out=buf)
+        layer = Layer(anim, buf, mode, opacity)
+
+        if index is None:
+            self.layers.append(layer)
+        else:
+            self.layers.insert(index, layer)
+        self.layers_changed = True
+
+        return layer
+
+    def remove_layer(self, layer):
+        self.layers.remove(layer)
+        self.free_bufs.append(layer.buf)
+        self.layers_changed = True
+
+    def crossfade(self, anim_class, num_beats, *args):
+        """
+        Crossfade the bottom layer into a new animation over some number
+        of beats. Any crossfade in progress is completed immediately.
+        """
+
+        if self.fade_layer:
+            self._end_fade()
+
+        if not self.layers:
+            return self.add_layer(anim_class, *args)
+
+        self.fade_layer = self.add_layer(
+            anim_class,
+            *args,
+            mode='alpha',
+            opacity=0,
+            index=1
+        )
+        self.fade_beats = num_beats
+        self.fade_count = 0
+
+        return self.fade_layer
+
+    def _end_fade(self):
+        """
+        Replace the bottom layer by the layer faded in
+        """
+
+        self.remove_layer(self.layers[0])
+        self.fade_layer.mode = 'add'
+        self.fade_layer.opacity = 1
+        self.fade_layer = None
+
+    def pulse(self, t):
+        if self.pulse_time is not None:
+            self.beat_interval = t - self.pulse_time
+        self.pulse_time = t
+
+        for layer in self.layers:
+            start = time.perf_counter()
+            layer.anim.pulse(t)
+            stats.record(layer.pulse_key, time.perf_counter() - start)
+
+        if self.fade_layer:
+            self.fade_count += 1
+
+    def update(self, t):
+        changed = self.layers_changed
+        self.layers_changed = False
+
+        for layer in self.layers:
+            start = time.perf_counter()
+            changed |= layer.anim.render(t)
+            stats.record(layer.update_key, time.perf_counter() - start)
+
+        # Advance the crossfade smoothly between beats
+        if self.fade_layer:
+            since_pulse = 0 if self.pulse_time is None else t - self.pulse_time
+            frac = min(1, since_pulse / max(self.beat_interval, 1e-3))
+            progress = (self.fade_count + frac) / self.fade_beats
+
+            if self.fade_count >= self.fade_beats:
+                self._end_fade()
+            else:
+                self.fade_layer.opacity = min(1, progress)
+            changed = True
+
+        # None of the layers changed, the output is the same
+        if not changed:
+            return False
+
+        start = time.perf_counter()
+        self.composite()
+        stats.record('mixer.composite', time.perf_counter() - start)
+
+    def composite(self):
+        """
+        Blend the layers into the output buffer. Every operation is done
+        in place, using one scratch buffer, so no temporaries are allocated.
+        """
+
+        out = self.out
+        tmp = self.scratch('blend', out.shape)
+
+        if not self.layers:
+            out[:] = 0
+            return
+
+        base = self.layers[0]
+        np.multiply(base.buf, base.opacity, out=out)
+
+        for layer in self.layers[1:]:
+            op = layer.opacity
+            buf = layer.buf
+
+            if op <= 0:
+                continue
+
+            if layer.mode == 'add':
+                np.multiply(buf, op, out=tmp)
+                np.add(out, tmp, out=out)
+
+            elif layer.mode == 'max':
+                np.multiply(buf, op, out=tmp)
+                np.maximum(out, tmp, out=out)
+
+            elif layer.mode == 'multiply':
+                # out *= 1 + op * (buf - 1)
+                np.subtract(buf, 1, out=tmp)
+                tmp *= op
+                tmp += 1
+                np.multiply(out, tmp, out=out)
+
+            elif layer.mode == 'alpha':
+                # out += op * (buf - out)
+                np.subtract(buf, out, out=tmp)
+                tmp *= op
+                np.add(out, tmp, out=out)
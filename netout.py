@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+Network LED output using DDP (Distributed Display Protocol), which most
+networked pixel controllers (WLED, ESPixelStick, Falcon) accept. Packed
+frames are split into preallocated UDP packets and sent in one batched
+sendmmsg call.
+"""
+
+import os
+import time
+import errno
+import struct
+import socket
+import ctypes
+import argparse
+import numpy as np
+from stats import stats
+from delta import DeltaEncoder, DELTA
+
+DDP_PORT = 4048
+
+# DDP header: flags, sequence number, data type, destination id,
+# data offset (big endian) and data length (big endian)
+DDP_HEADER_SIZE = 10
+DDP_VERSION = 0x40
+DDP_PUSH = 0x01
+DDP_TYPE_RGB8 = 0x0B
+DDP_ID_DISPLAY = 1
+
+# Pixel data per packet, 480 RGB pixels, which keeps packets
+# under the usual 1500 byte Ethernet MTU
+DDP_MAX_DATA = 1440
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+def load_sendmmsg():
+    """
+    Get the sendmmsg function from the C library, or None if it isn't
+    available (it is Linux specific)
+    """
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fn = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    fn.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    fn.restype = ctypes.c_int
+    return fn
+
+class PacketBatch:
+    """
+    Preallocated packet buffers, with the message headers to send
+    them all with one sendmmsg call
+    """
+
+    def __init__(self, num_packets):
+        self.num_packets = num_packets
+        self.packets = np.zeros((num_packets, DDP_HEADER_SIZE + DDP_MAX_DATA), dtype=np.uint8)
+
+        self.iovecs = (iovec * num_packets)()
+        self.msgs = (mmsghdr * num_packets)()
+
+        for idx in range(num_packets):
+            self.iovecs[idx].iov_base = self.packets[idx].ctypes.data
+            self.msgs[idx].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[idx])
+            self.msgs[idx].msg_hdr.msg_iovlen = 1
+
+    def set_header(self, idx, offset, length, push):
+        """
+        Fill in the header of a packet, except for the sequence number
+        """
+
+        header = self.packets[idx, :DDP_HEADER_SIZE]
+        header[0] = DDP_VERSION | (DDP_PUSH if push else 0)
+        header[2] = DDP_TYPE_RGB8
+        header[3] = DDP_ID_DISPLAY
+        struct.pack_into('>IH', header, 4, offset, length)
+        self.iovecs[idx].iov_len = DDP_HEADER_SIZE + length
+
+class DdpSink:
+    """
+    LED sink sending the packed frames to a DDP controller. The packets
+    and their headers are preallocated, and each frame only copies the
+    packed bytes into the packets and sends them all in one system call.
+
+    With delta encoding, only the spans of LEDs that changed since the
+    last frame are sent, using the data offset of the DDP packets, with
+    periodic full frames so the controller recovers from lost packets.
+    """
+
+    def __init__(self, host, num_leds, port=DDP_PORT, delta=False):
+        self.num_leds = num_leds
+
+        # The packets are sent as DDP_TYPE_RGB8
+        self.order = 'RGB'
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((host, port))
+
+        num_bytes = 3 * num_leds
+        self.num_packets = max(1, -(-num_bytes // DDP_MAX_DATA))
+
+        # Packets of full frames, the headers never change
+        self.full = PacketBatch(self.num_packets)
+        for idx in range(self.num_packets):
+            offset = idx * DDP_MAX_DATA
+            length = min(num_bytes - offset, DDP_MAX_DATA)
+            self.full.set_header(idx, offset, length, idx == self.num_packets - 1)
+
+        # Data area of the full packets, and of the last packet if it
+        # is partial, so frames are copied in with two assignments
+        num_full = num_bytes // DDP_MAX_DATA
+        self.full_data = self.full.packets[:num_full, DDP_HEADER_SIZE:]
+        self.full_bytes = num_full * DDP_MAX_DATA
+        tail_bytes = num_bytes - self.full_bytes
+        self.tail_data = self.full.packets[-1, DDP_HEADER_SIZE:DDP_HEADER_SIZE+tail_bytes]
+
+        # Packets of delta frames, a delta frame needing more
+        # packets than a full frame is sent as a full frame
+        self.encoder = None
+        if delta:
+            self.encoder = DeltaEncoder(num_leds, merge_gap=16)
+            self.spans = PacketBatch(self.num_packets)
+
+        self.sendmmsg = load_sendmmsg()
+        self.sequence = 0
+
+        self.num_frames = 0
+        self.num_errors = 0
+        self.num_bytes = 0
+
+    def write(self, packed):
+        if self.encoder is not None:
+            frame = self.encoder.encode(packed)
+            if frame.kind == DELTA:
+                num_packets = self._pack_spans(frame)
+                if num_packets == 0:
+                    return
+                if num_packets is not None:
+                    self._send_frame(self.spans, num_packets)
+                    return
+
+        flat = packed.reshape(-1)
+        self.full_data[:] = flat[:self.full_bytes].reshape(self.full_data.shape)
+        if len(self.tail_data):
+            self.tail_data[:] = flat[self.full_bytes:]
+
+        self._send_frame(self.full, self.num_packets)
+
+    def poll(self):
+        """
+        Called between frames when nothing changed. With delta encoding,
+        the last frame is sent again as a keyframe when a refresh is due,
+        so the controller recovers from lost packets even on still frames.
+        """
+
+        if self.encoder is not None and self.encoder.refresh_due():
+            self.write(self.encoder.prev)
+
+    def _pack_spans(self, frame):
+        """
+        Copy the changed spans of a delta frame into packets. Returns
+        the number of packets, or None if they don't all fit.
+        """
+
+        data = frame.data.reshape(-1)
+        data_pos = 0
+        idx = 0
+
+        for start, end in frame.spans * 3:
+            for offset in range(start, end, DDP_MAX_DATA):
+                if idx == self.num_packets:
+                    return None
+
+                length = min(end - offset, DDP_MAX_DATA)
+                self.spans.set_header(idx, offset, length, False)
+                self.spans.packets[idx, DDP_HEADER_SIZE:DDP_HEADER_SIZE+length] = data[data_pos:data_pos+length]
+                data_pos += length
+                idx += 1
+
+        if idx > 0:
+            self.spans.packets[idx - 1, 0] |= DDP_PUSH
+
+        return idx
+
+    def _send_frame(self, batch, num_packets):
+        # Sequence numbers go from 1 to 15, 0 means not used
+        self.sequence = self.sequence % 15 + 1
+        batch.packets[:num_packets, 1] = self.sequence
+
+        start = time.perf_counter()
+        self.send(batch, num_packets)
+        stats.record('ddp.send', time.perf_counter() - start)
+
+        self.num_frames += 1
+        self.num_bytes += sum(batch.iovecs[idx].iov_len for idx in range(num_packets))
+
+    def send(self, batch, num_packets):
+        """
+        Send the first packets of a batch
+        """
+
+        if self.sendmmsg is None:
+            for idx in range(num_packets):
+                self._send_one(batch, idx)
+            return
+
+        fd = self.sock.fileno()
+        sent = 0
+
+        while sent < num_packets:
+            msgs = ctypes.byref(batch.msgs, sent * ctypes.sizeof(mmsghdr))
+            n = self.sendmmsg(fd, ctypes.cast(msgs, ctypes.POINTER(mmsghdr)), num_packets - sent, 0)
+
+            if n < 0:
+                err = ctypes.get_errno()
+
+                # With a connected UDP socket, an ICMP error caused by a
+                # previous send is reported here, skip the failed packet
+                if err != errno.ECONNREFUSED:
+                    raise OSError(err, os.strerror(err))
+                self.num_errors += 1
+                n = 1
+
+            sent += n
+
+    def _send_one(self, batch, idx):
+        length = batch.iovecs[idx].iov_len
+        try:
+            self.sock.send(batch.packets[idx, :length])
+        except ConnectionRefusedError:
+            # Nobody listening on the other end (yet)
+            self.num_errors += 1
+
+    def close(self):
+        self.sock.close()
+
+    def stats(self):
+        return {
+            'frames': self.num_frames,
+            'bytes': self.num_bytes,
+            'errors': self.num_errors,
+        }
+
+class DdpReceiver:
+    """
+    Minimal DDP receiver, standing in for a pixel controller. Packets
+    are assembled into frames, and each frame is passed to a callback
+    when a packet with the push flag arrives.
+    """
+
+    def __init__(self, num_leds, port=DDP_PORT, host='127.0.0.1'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+
+        self.frame = np.zeros(num_leds * 3, dtype=np.uint8)
+        self.packet = bytearray(DDP_HEADER_SIZE + DDP_MAX_DATA)
+
+        self.num_packets = 0
+        self.num_frames = 0
+
+        # Number of frames with a sequence number gap before them
+        self.num_gaps = 0
+        self.sequence = 0
+
+    def receive(self, on_frame, timeout=None):
+        """
+        Receive packets until the timeout expires without any packet
+        """
+
+        self.sock.settimeout(timeout)
+        view = memoryview(self.packet)
+
+        while True:
+            try:
+                n = self.sock.recv_into(self.packet)
+            except socket.timeout:
+                return
+
+            if n < DDP_HEADER_SIZE:
+                continue
+            self.num_packets += 1
+
+            flags, seq, _, _ = self.packet[:4]
+            offset = int.from_bytes(self.packet[4:8], 'big')
+            length = int.from_bytes(self.packet[8:10], 'big')
+            length = min(length, n - DDP_HEADER_SIZE, len(self.frame) - offset)
+            self.frame[offset:offset+length] = np.frombuffer(view[DDP_HEADER_SIZE:DDP_HEADER_SIZE+length], dtype=np.uint8)
+
+            if flags & DDP_PUSH:
+                if self.sequence and seq and seq != self.sequence % 15 + 1:
+                    self.num_gaps += 1
+                self.sequence = seq
+                self.num_frames += 1
+                on_frame(self.frame)
+
+    def close(self):
+        self.sock.close()
+
+def record_frames(path, num_leds, port, timeout):
+    """
+    Receive DDP frames and append them to a file, as raw RGB bytes
+    """
+
+    receiver = DdpReceiver(num_leds, port)
+
+    with open(path, 'wb') as f:
+        receiver.receive(lambda frame: f.write(frame.tobytes()), timeout)
+
+    receiver.close()
+    print('{} packets, {} frames, {} sequence gaps'.format(
+        receiver.num_packets, receiver.num_frames, receiver.num_gaps
+    ))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='loopback DDP receiver, records the frames sent by main.py')
+    parser.add_argument('path', help='file to append the received frames to')
+    parser.add_argument('--num-leds', type=int, required=True)
+    parser.add_argument('--port', type=int, default=DDP_PORT)
+    parser.add_argument('--timeout', type=float, default=5, help='stop after this long without packets (seconds)')
+    args = parser.parse_args()
+
+    record_frames(args.path, args.num_leds, args.port, args.timeout)
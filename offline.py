@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+Offline audio analysis for planned sets. Tracks are analyzed in batch,
+with the same onset detection and tempo tracking as the live audio
+path, and the beat grid and audio features are cached to disk. During
+the show, GridPlayer replays the analysis with no live DSP cost.
+"""
+
+import os
+import math
+import struct
+import hashlib
+import argparse
+import numpy as np
+import beat
+
+# Bump this when the analysis changes, to invalidate cached results
+ANALYSIS_VERSION = 1
+
+# Directory where analysis results are cached
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ledburn')
+
+def read_wav(path):
+    """
+    Memory-map the samples of a PCM or float WAV file.
+    Returns the sample rate and a (num_frames, channels) array.
+    """
+
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError('not a WAV file: ' + path)
+
+        fmt = None
+
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError('no data chunk in ' + path)
+
+            chunk_id, size = struct.unpack('<4sI', header)
+
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', f.read(16))
+                f.seek(size - 16 + (size & 1), os.SEEK_CUR)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+
+    if fmt is None:
+        raise ValueError('no fmt chunk in ' + path)
+
+    tag, channels, samplerate, _, _, bits = fmt
+
+    # WAVE_FORMAT_EXTENSIBLE, assume the subformat matches the bit depth
+    if tag == 0xFFFE:
+        tag = 3 if bits == 32 else 1
+
+    dtypes = {
+        (1, 8): np.uint8,
+        (1, 16): np.int16,
+        (1, 32): np.int32,
+        (3, 32): np.float32,
+        (3, 64): np.float64,
+    }
+
+    if (tag, bits) not in dtypes:
+        raise ValueError('unsupported WAV format {} ({} bits)'.format(tag, bits))
+
+    dtype = np.dtype(dtypes[(tag, bits)])
+    num_frames = size // (dtype.itemsize * channels)
+
+    samples = np.memmap(
+        path,
+        dtype=dtype,
+        mode='r',
+        offset=offset,
+        shape=(num_frames, channels)
+    )
+
+    return samplerate, samples
+
+def to_mono(samples):
+    """
+    Mix down to a float32 mono signal between -1 and 1
+    """
+
+    if samples.dtype == np.uint8:
+        scale, bias = 1 / 128, -1
+    elif samples.dtype == np.int16:
+        scale, bias = 1 / 32768, 0
+    elif samples.dtype == np.int32:
+        scale, bias = 1 / 2147483648, 0
+    else:
+        scale, bias = 1, 0
+
+    mono = samples.mean(axis=1, dtype=np.float32)
+    mono *= scale
+    mono += bias
+    return mono
+
+def ema(x, gamma, init):
+    """
+    Exponential moving average y[i] = gamma * y[i-1] + (1 - gamma) * x[i],
+    vectorized in chunks so that the powers of gamma stay well scaled
+    """
+
+    chunk = 512
+    k = np.arange(chunk)
+    powers = gamma ** (k[:, np.newaxis] - k[np.newaxis, :])
+    lower = np.tril(powers) * (1 - gamma)
+    decay = gamma ** (k + 1)
+
+    y = np.empty(len(x))
+    prev = init
+
+    for start in range(0, len(x), chunk):
+        xs = x[start:start+chunk]
+        n = len(xs)
+        y[start:start+n] = lower[:n, :n] @ xs + decay[:n] * prev
+        prev = y[start+n-1]
+
+    return y
+
+def decaying_peak(x, decay, init):
+    """
+    Running peak p[i] = max(p[i-1] * decay, x[i]), computed in the log
+    domain as a cumulative maximum
+    """
+
+    i = np.arange(len(x))
+    log_decay = math.log(decay)
+    log_x = np.log(np.maximum(x, 1e-30)) - i * log_decay
+    log_x[0] = max(log_x[0], math.log(init) + log_decay)
+    return np.exp(np.maximum.accumulate(log_x) + i * log_decay)
+
+def analyze(samplerate, mono, block_frames=1024):
+    """
+    Run the onset detection and feature extraction over a whole track.
+    Returns the hop times, the onset times and the features per hop.
+    """
+
+    # Use the live detector for all the analysis parameters
+    det = beat.BeatDetector(samplerate, bus=None)
+    fft_size = det.fft_size
+    hop = det.hop_size
+
+    # Pad the start like the live ring buffer, so that hop i
+    # analyzes the fft_size samples ending at sample (i+1)*hop-1
+    padded = np.concatenate([np.zeros(fft_size - hop, np.float32), mono])
+    frames = np.lib.stride_tricks.sliding_window_view(padded, fft_size)[::hop]
+    num_hops = len(frames)
+
+    times = (np.arange(num_hops) + 1) * hop / samplerate
+    energy = np.empty(num_hops)
+    bands = np.empty((num_hops, len(beat.BANDS)))
+    flux = np.empty(num_hops)
+    rms = np.empty(num_hops)
+    prev_mag = np.zeros(fft_size // 2 + 1, dtype=np.float32)
+
+    for start in range(0, num_hops, block_frames):
+        block = frames[start:start+block_frames] * det.window
+        mag = np.abs(np.fft.rfft(block, axis=-1)).astype(np.float32)
+
+        end = start + len(block)
+        energy[start:end] = mag[:, :len(det.weights)] @ det.weights
+        bands[start:end] = (mag * mag) @ det.filterbank.T
+
+        diff = np.diff(mag, axis=0, prepend=prev_mag[np.newaxis])
+        flux[start:end] = np.maximum(diff, 0).sum(axis=-1)
+        prev_mag = mag[-1]
+
+        tail = frames[start:end, -hop:]
+        rms[start:end] = np.sqrt(np.mean(tail * tail, axis=-1))
+
+    # Onset threshold against the moving statistics before each hop
+    avg = ema(energy, det.gamma, det.moving_avg)
+    var = ema(energy ** 2, det.gamma, det.moving_var)
+    prev_avg = np.concatenate([[det.moving_avg], avg[:-1]])
+    prev_std = np.sqrt(np.concatenate([[det.moving_var], var[:-1]]))
+    above = (energy - prev_avg) / prev_std - 0.5 > 0
+
+    # Rising edges, with the minimum interval between pulses
+    rising = np.flatnonzero(above & ~np.concatenate([[False], above[:-1]]))
+    onsets = []
+    for t in times[rising]:
+        if not onsets or t - onsets[-1] >= det.min_interval:
+            onsets.append(t)
+
+    # Normalize the features like the live detector
+    features = np.zeros((num_hops, beat.NUM_FEATURES), dtype=np.float32)
+    for band_idx in range(len(beat.BANDS)):
+        peak = decaying_peak(bands[:, band_idx], det.peak_decay, 1e-9)
+        features[:, beat.FEAT_BASS + band_idx] = bands[:, band_idx] / peak
+    features[:, beat.FEAT_RMS] = rms
+    features[:, beat.FEAT_FLUX] = flux / decaying_peak(flux, det.peak_decay, 1e-9)
+
+    # Envelope follower, this is sequential but cheap
+    env = 0
+    envelope = features[:, beat.FEAT_ENVELOPE]
+    for i, x in enumerate(rms):
+        env += (det.attack if x > env else det.release) * (x - env)
+        envelope[i] = env
+
+    return times, np.array(onsets), features
+
+def beat_grid(onsets, duration):
+    """
+    Run the tempo tracker over the onsets of a track and
+    return the times at which it emits pulses
+    """
+
+    beats = []
+    tracker = beat.TempoTracker(on_pulse=beats.append)
+
+    def advance(t):
+        while tracker.next_beat <= t:
+            tracker.poll(tracker.next_beat)
+
+    for t in onsets:
+        advance(t)
+        tracker.onset(t)
+
+    advance(duration)
+
+    return np.array(beats)
+
+def file_hash(path):
+    """
+    Hash the contents of a file
+    """
+
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def load_analysis(path, cache_dir=CACHE_DIR):
+    """
+    Load the analysis of a track from the cache,
+    or analyze the track and cache the results
+    """
+
+    key = '{}-v{}'.format(file_hash(path), ANALYSIS_VERSION)
+    cache_path = os.path.join(cache_dir, key + '.npz')
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            return {name: data[name] for name in data.files}
+
+    samplerate, samples = read_wav(path)
+    mono = to_mono(samples)
+    times, onsets, features = analyze(samplerate, mono)
+    beats = beat_grid(onsets, len(mono) / samplerate)
+
+    result = {
+        'times': times,
+        'onsets': onsets,
+        'beats': beats,
+        'features': features,
+    }
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = cache_path + '.tmp.npz'
+    np.savez(tmp_path, **result)
+    os.replace(tmp_path, cache_path)
+
+    return result
+
+class GridPlayer:
+    """
+    Replay a cached track analysis in sync with the music. Pulses are
+    emitted at the beat times and the features are written to the bus.
+    """
+
+    def __init__(self, analysis, on_pulse=None, bus=beat.features):
+        self.beats = analysis['beats']
+        self.times = analysis['times']
+        self.features = analysis['features']
+
+        self.on_pulse = on_pulse
+        self.bus = bus
+
+        # Time at which the track started playing
+        self.start_time = None
+
+        # Index of the next beat to emit
+        self.beat_idx = 0
+
+        # Index of the last hop written to the bus
+        self.hop_idx = -1
+
+    def start(self, t):
+        self.start_time = t
+        self.beat_idx = 0
+        self.hop_idx = -1
+
+    @property
+    def done(self):
+        return self.beat_idx >= len(self.beats)
+
+    def poll(self, t):
+        """
+        Called at every frame, with the current time
+        """
+
+        rel = t - self.start_time
+
+        while self.beat_idx < len(self.beats) and self.beats[self.beat_idx] <= rel:
+            self.beat_idx += 1
+            if self.on_pulse:
+                self.on_pulse(t)
+
+        if self.bus is not None and len(self.times) > 0:
+            hop_idx = int(np.searchsorted(self.times, rel, side='right')) - 1
+
+            # Only publish new hops, so the bus count tells
+            # animations when the features changed
+            if hop_idx >= 0 and hop_idx != self.hop_idx:
+                self.hop_idx = hop_idx
+                self.bus.values[:] = self.features[hop_idx]
+                self.bus.time = t
+                self.bus.count += 1
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='analyze tracks and cache their beat grids')
+    parser.add_argument('tracks', nargs='+', help='WAV files to analyze')
+    args = parser.parse_args()
+
+    for path in args.tracks:
+        analysis = load_analysis(path)
+        beats = analysis['beats']
+        bpm = 60 / np.median(np.diff(beats)) if len(beats) > 1 else 0
+        print('{}: {} onsets, {} beats, ~{:.1f} BPM'.format(
+            path, len(analysis['onsets']), len(beats), bpm
+        ))
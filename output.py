@@ -0,0 +1,423 @@
+"""
+LED output. Frames are converted from float pixels to 8-bit wire bytes
+in one vectorized pass, and handed to the LED driver in one bulk write.
+"""
+
+import sys
+import time
+import ctypes
+import threading
+import traceback
+import numpy as np
+from stats import stats
+
+# GPIO pin and DMA channel of the two PWM channels of the Pi
+WS281X_CHANNELS = {
+    0: (18, 10),
+    1: (13, 11),
+}
+
+# Size of the gamma lookup table, enough that the 8-bit output is
+# smooth at low brightness after gamma correction
+LUT_SIZE = 4096
+
+class Packer:
+    """
+    Convert float RGB frames to 8-bit LED bytes: global brightness,
+    clipping, gamma correction through a lookup table, and reordering
+    of the color channels into the order the LEDs expect (GRB for WS2812).
+    Every step writes into preallocated buffers.
+    """
+
+    def __init__(self, num_leds, gamma=2.2, brightness=1.0, order='GRB'):
+        self.num_leds = num_leds
+        self.brightness = brightness
+
+        # Source RGB channel of each output byte
+        self.order = ['RGB'.index(c) for c in order]
+
+        # Gamma lookup table, from scaled linear values to 8-bit values
+        x = np.linspace(0, 1, LUT_SIZE)
+        self.lut = np.round(255 * x ** gamma).astype(np.uint8)
+
+        # Packed bytes, in LED order
+        self.out = np.zeros((num_leds, 3), dtype=np.uint8)
+
+        self.scaled = np.zeros(num_leds, dtype=np.float32)
+        self.idx = np.zeros(num_leds, dtype=np.intp)
+
+    def pack(self, pixels):
+        """
+        Pack a (num_leds, 3) float frame, returns the packed bytes
+        """
+
+        scale = (LUT_SIZE - 1) * self.brightness
+
+        for k, src in enumerate(self.order):
+            np.multiply(pixels[:, src], scale, out=self.scaled)
+            np.add(self.scaled, 0.5, out=self.scaled)
+
+            # Note: fmax maps NaNs to zero, unlike clip
+            np.fmax(self.scaled, 0, out=self.scaled)
+            np.minimum(self.scaled, LUT_SIZE - 1, out=self.scaled)
+            np.copyto(self.idx, self.scaled, casting='unsafe')
+            np.take(self.lut, self.idx, out=self.out[:, k], mode='clip')
+
+        return self.out
+
+class Ws281xStrip:
+    """
+    WS281x LED strip driven through the rpi_ws281x library. The packed
+    frame is copied into the driver's LED array in one memmove.
+    """
+
+    def __init__(
+        self,
+        num_leds,
+        pin=18,
+        freq_hz=800000,
+        dma=10,
+        invert=False,
+        channel=0
+    ):
+        import rpi_ws281x
+
+        # The channels are already packed in wire order, so the
+        # driver must send the color words as is
+        self.strip = rpi_ws281x.PixelStrip(
+            num_leds,
+            pin,
+            freq_hz,
+            dma,
+            invert,
+            255,
+            channel,
+            strip_type=rpi_ws281x.WS2811_STRIP_RGB
+        )
+        self.strip.begin()
+
+        self.num_leds = num_leds
+
+        # Order of the color channels on the wire
+        self.order = 'GRB'
+
+        # Address of the driver's array of 32-bit color words
+        leds = rpi_ws281x.ws.ws2811_channel_t_leds_get(self.strip._channel)
+        self.leds_addr = int(leds)
+
+        # Color words, 0x00XXYYZZ for wire bytes XX, YY, ZZ
+        self.words = np.zeros((num_leds, 4), dtype=np.uint8)
+        self.byte_idx = [2, 1, 0] if sys.byteorder == 'little' else [1, 2, 3]
+
+    def write(self, packed):
+        for k, byte_idx in enumerate(self.byte_idx):
+            self.words[:, byte_idx] = packed[:, k]
+
+        ctypes.memmove(self.leds_addr, self.words.ctypes.data, self.words.nbytes)
+        self.strip.show()
+
+    def close(self):
+        self.words[:] = 0
+        ctypes.memmove(self.leds_addr, self.words.ctypes.data, self.words.nbytes)
+        self.strip.show()
+
+class MockStrip:
+    """
+    Stand-in for an LED strip, writing the packed frames to a
+    memory-mapped file, so the output can be checked byte for
+    byte without hardware
+    """
+
+    def __init__(self, path, num_leds):
+        self.path = path
+        self.num_leds = num_leds
+        self.bytes = np.memmap(path, dtype=np.uint8, mode='w+', shape=(num_leds, 3))
+
+        # Same channel order as the WS2812 strips this stands in for
+        self.order = 'GRB'
+
+        # Number of frames written
+        self.num_frames = 0
+
+    def write(self, packed):
+        self.bytes[:] = packed
+        self.num_frames += 1
+
+    def close(self):
+        self.bytes.flush()
+
+class Output:
+    """
+    Pushes rendered frames to an LED sink. Frames with the same
+    generation as the last frame written are skipped.
+    Sinks have num_leds and order (of the color channels, eg: 'GRB')
+    attributes, and write and close methods. Sinks with work to do
+    between frames (eg: finishing a slow write) also have a poll method,
+    called when a frame is skipped.
+    """
+
+    def __init__(self, sink, packer):
+        self.sink = sink
+        self.packer = packer
+
+        # Generation of the last frame written
+        self.generation = None
+
+        self.num_writes = 0
+        self.num_skipped = 0
+
+    def push(self, pixels, generation=None, valid=None):
+        """
+        Write a frame to the sink. The optional valid function is
+        called once the frame is packed, and returns False if the
+        pixels were overwritten while being packed, in which case
+        nothing is written. Returns True if the frame was written.
+        """
+
+        if generation is not None and generation == self.generation:
+            self.num_skipped += 1
+            self.poll()
+            return False
+
+        start = time.perf_counter()
+        packed = self.pack(pixels)
+        stats.record('output.pack', time.perf_counter() - start)
+
+        if valid is not None and not valid():
+            return False
+
+        self.write(packed)
+
+        self.generation = generation
+        self.num_writes += 1
+        return True
+
+    def pack(self, pixels):
+        return self.packer.pack(pixels)
+
+    def poll(self):
+        if hasattr(self.sink, 'poll'):
+            self.sink.poll()
+
+    def write(self, packed):
+        start = time.perf_counter()
+        self.sink.write(packed)
+        stats.record('output.write', time.perf_counter() - start)
+
+    def close(self):
+        self.sink.close()
+
+    def stats(self):
+        counters = {
+            'writes': self.num_writes,
+            'skipped': self.num_skipped,
+        }
+
+        # Some sinks have their own counters
+        if hasattr(self.sink, 'stats'):
+            counters['sink'] = self.sink.stats()
+
+        return counters
+
+class Shard:
+    """
+    Sink driving a contiguous range of edges, with its own writer thread
+    """
+
+    def __init__(self, sink, leds, name, packer):
+        self.sink = sink
+        self.name = name
+
+        # Slice of the LEDs driven by this sink
+        self.leds = leds
+
+        # Packer for the LEDs of this sink, in its channel order
+        self.packer = packer
+
+        # Packed LED bytes to write next, None to poll the sink instead
+        self.packed = None
+
+        # Set when there is a frame to write, and when it is written
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.done.set()
+
+        self.stats_key = 'output.write.' + name
+        self.num_writes = 0
+        self.num_errors = 0
+
+        self.thread = None
+
+class ShardedOutput(Output):
+    """
+    Output split across several sinks (eg: DMA channels, SPI buses,
+    network controllers) driving different ranges of edges. Each shard
+    packs its range of LEDs in the channel order of its sink, and the
+    sinks are written concurrently from their own threads.
+
+    Pushing a frame doesn't wait for the sinks, so they are written
+    while the next frame renders. Only the next push waits for them.
+    """
+
+    def __init__(self, struct, shards, gamma=2.2, brightness=1.0):
+        """
+        The shards are a list of (name, sink, first_edge, end_edge)
+        tuples, with the edge ranges in wiring order.
+        """
+
+        super().__init__(None, None)
+
+        self.shards = []
+
+        for name, sink, first_edge, end_edge in shards:
+            start = int(struct.edge_starts[first_edge])
+            end = int(struct.edge_starts[end_edge - 1] + struct.edge_lengths[end_edge - 1])
+            assert sink.num_leds == end - start
+            packer = Packer(sink.num_leds, gamma, brightness, sink.order)
+            self.shards.append(Shard(sink, slice(start, end), name, packer))
+
+        self.running = True
+
+        for shard in self.shards:
+            shard.thread = threading.Thread(target=self._writer, args=(shard,), daemon=True)
+            shard.thread.start()
+
+    def _writer(self, shard):
+        while True:
+            shard.ready.wait()
+            shard.ready.clear()
+
+            if not self.running:
+                break
+
+            packed = shard.packed
+
+            start = time.perf_counter()
+            try:
+                if packed is None:
+                    shard.sink.poll()
+                else:
+                    shard.sink.write(packed)
+                    shard.num_writes += 1
+            except OSError:
+                shard.num_errors += 1
+            except Exception:
+                # Keep the thread alive, a bug in one sink shouldn't
+                # stop the others, but don't hide it either
+                shard.num_errors += 1
+                traceback.print_exc()
+            finally:
+                # Even if the sink failed, so push doesn't wait forever
+                shard.done.set()
+
+            if packed is not None:
+                stats.record(shard.stats_key, time.perf_counter() - start)
+
+    def wait(self):
+        """
+        Wait until the sinks are done writing the last frame
+        """
+        for shard in self.shards:
+            shard.done.wait()
+
+    def push(self, pixels, generation=None, valid=None):
+        # The packed frame can't change while the sinks are writing it
+        self.wait()
+        return super().push(pixels, generation, valid)
+
+    def pack(self, pixels):
+        for shard in self.shards:
+            shard.packed = shard.packer.pack(pixels[shard.leds])
+
+    def poll(self):
+        # Polled from the writer threads too, since sinks aren't thread safe
+        for shard in self.shards:
+            if hasattr(shard.sink, 'poll'):
+                shard.packed = None
+                shard.done.clear()
+                shard.ready.set()
+
+    def write(self, packed):
+        for shard in self.shards:
+            shard.done.clear()
+            shard.ready.set()
+
+    def close(self):
+        self.wait()
+        self.running = False
+
+        for shard in self.shards:
+            shard.ready.set()
+            shard.thread.join()
+            shard.sink.close()
+
+    def stats(self):
+        counters = super().stats()
+
+        for shard in self.shards:
+            counters[shard.name] = {
+                'writes': shard.num_writes,
+                'errors': shard.num_errors,
+            }
+            if hasattr(shard.sink, 'stats'):
+                counters[shard.name]['sink'] = shard.sink.stats()
+
+        return counters
+
+def open_sink(spec, num_leds, delta=False):
+    """
+    Create a sink from a command line spec. With delta encoding,
+    network sinks only send the LEDs that changed.
+    """
+
+    if spec == 'ws281x' or spec.startswith('ws281x:'):
+        channel = int(spec[len('ws281x:'):] or 0)
+        pin, dma = WS281X_CHANNELS[channel]
+        return Ws281xStrip(num_leds, pin=pin, dma=dma, channel=channel)
+
+    if spec.startswith('mock:'):
+        return MockStrip(spec[len('mock:'):], num_leds)
+
+    if spec.startswith('ddp:'):
+        from netout import DdpSink, DDP_PORT
+        host, _, port = spec[len('ddp:'):].partition(':')
+        return DdpSink(host, num_leds, int(port or DDP_PORT), delta)
+
+    if spec.startswith('serial:'):
+        from serialout import SerialSink
+        return SerialSink(spec[len('serial:'):], num_leds)
+
+    raise ValueError('unknown output: ' + spec)
+
+def open_output(spec, struct, gamma=2.2, brightness=1.0, delta=False):
+    """
+    Create an output from a command line spec: 'ws281x', 'ws281x:1'
+    (second PWM channel), 'ddp:' followed by a controller address and
+    optional port, 'serial:' followed by the path of a serial device, or
+    'mock:' followed by the path of the file to write. Several outputs
+    driving ranges of edges can be given, separated by commas, each
+    followed by '@first_edge:end_edge', eg: 'ws281x@0:6,ddp:10.0.0.2@6:12'
+    (at most one of them can be a ws281x output).
+    """
+
+    if '@' not in spec:
+        sink = open_sink(spec, struct.num_leds, delta)
+        return Output(sink, Packer(struct.num_leds, gamma, brightness, sink.order))
+
+    parts = [part.rsplit('@', 1) for part in spec.split(',')]
+
+    # Each strip initializes the PWM block shared by both channels,
+    # so a second strip would break the first one
+    sink_specs = [sink_spec for sink_spec, _ in parts]
+    if sum(s == 'ws281x' or s.startswith('ws281x:') for s in sink_specs) > 1:
+        raise ValueError('only one ws281x output can be used at a time: ' + spec)
+
+    shards = []
+
+    for sink_spec, edge_range in parts:
+        first_edge, end_edge = (int(e) for e in edge_range.split(':'))
+        num_leds = int(struct.edge_lengths[first_edge:end_edge].sum())
+        sink = open_sink(sink_spec, num_leds, delta)
+        shards.append((sink_spec, sink, first_edge, end_edge))
+
+    return ShardedOutput(struct, shards, gamma, brightness)
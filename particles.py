@@ -0,0 +1,164 @@
+import numpy as np
+
+class Particles:
+    """
+    Particles moving along the edges of a structure. The particle state
+    is stored as parallel arrays (struct of arrays), so that moving,
+    branching and drawing thousands of particles are all vectorized.
+
+    Each particle is on one edge, at a position from 0 (start vertex)
+    to 1 (end vertex), and moves with a signed speed (positive towards
+    the end vertex) in world units per second. When it reaches a vertex,
+    it continues on a random edge incident to that vertex.
+    """
+
+    def __init__(self, struct, capacity=4096):
+        self.struct = struct
+        self.capacity = capacity
+
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.edge = np.zeros(capacity, dtype=np.intp)
+        self.pos = np.zeros(capacity, dtype=np.float32)
+        self.speed = np.zeros(capacity, dtype=np.float32)
+        self.color = np.zeros((capacity, 3), dtype=np.float32)
+        self.age = np.zeros(capacity, dtype=np.float32)
+        self.life = np.zeros(capacity, dtype=np.float32)
+
+    @property
+    def num_alive(self):
+        return int(np.count_nonzero(self.alive))
+
+    def spawn(self, edge, pos, speed, color, life):
+        """
+        Spawn particles. The edge array gives the number of particles,
+        the other arguments can be arrays or scalars. Particles that
+        don't fit in the capacity are dropped.
+        """
+
+        edge = np.asarray(edge)
+        slots = np.flatnonzero(~self.alive)[:len(edge)]
+        n = len(slots)
+
+        self.alive[slots] = True
+        self.edge[slots] = edge[:n]
+        self.pos[slots] = np.broadcast_to(pos, edge.shape)[:n]
+        self.speed[slots] = np.broadcast_to(speed, edge.shape)[:n]
+        self.color[slots] = np.broadcast_to(color, edge.shape + (3,))[:n]
+        self.age[slots] = 0
+        self.life[slots] = np.broadcast_to(life, edge.shape)[:n]
+
+        return slots
+
+    def spawn_at_verts(self, verts, speed, color, life):
+        """
+        Spawn particles at vertices, leaving on a random incident edge.
+        The speed is the magnitude of the speed of the particles.
+        """
+
+        verts = np.asarray(verts)
+        slot = self._random_incident(verts, np.full(len(verts), -1))
+
+        edge = self.struct.vert_edges[slot]
+        at_end = self.struct.vert_edge_ends[slot] == 1
+        pos = np.where(at_end, 1, 0)
+        sign = np.where(at_end, -1, 1)
+
+        return self.spawn(edge, pos, sign * np.asarray(speed), color, life)
+
+    def _random_incident(self, verts, prev_edges):
+        """
+        Pick a random incident edge slot for each vertex, in the CSR
+        incidence arrays, avoiding the previous edge when possible
+        """
+
+        starts = self.struct.vert_edge_starts
+        degree = starts[verts + 1] - starts[verts]
+        r = (np.random.random(len(verts)) * degree).astype(np.intp)
+        slot = starts[verts] + r
+
+        # Don't go back on the same edge unless it's a dead end
+        back = (self.struct.vert_edges[slot] == prev_edges) & (degree > 1)
+        slot[back] = starts[verts[back]] + (r[back] + 1) % degree[back]
+
+        return slot
+
+    def step(self, dt, keep=None):
+        """
+        Move the particles forward in time. The optional keep function
+        is called with the indices, new edges and travel directions
+        (+1/-1) of the particles branching at a vertex, and returns a
+        mask of the particles that survive the branching.
+        """
+
+        struct = self.struct
+        idx = np.flatnonzero(self.alive)
+
+        self.age[idx] += dt
+        dead = idx[self.age[idx] >= self.life[idx]]
+        self.alive[dead] = False
+        idx = idx[self.age[idx] < self.life[idx]]
+
+        edge_lens = struct.edge_lens
+        self.pos[idx] += self.speed[idx] * dt / edge_lens[self.edge[idx]]
+
+        # Fast particles can cross several short edges in one step
+        for _ in range(8):
+            pos = self.pos[idx]
+            crossing = (pos > 1) | (pos < 0)
+            if not crossing.any():
+                break
+
+            idx = idx[crossing]
+            pos = pos[crossing]
+            old_edge = self.edge[idx]
+            at_end = pos > 1
+
+            # Distance travelled past the vertex
+            overflow = np.where(at_end, pos - 1, -pos) * edge_lens[old_edge]
+            verts = struct.edge_verts[old_edge, at_end.astype(np.intp)]
+
+            slot = self._random_incident(verts, old_edge)
+            new_edge = struct.vert_edges[slot]
+            leaves_end = struct.vert_edge_ends[slot] == 1
+            direction = np.where(leaves_end, -1, 1)
+
+            if keep is not None:
+                mask = keep(idx, new_edge, direction)
+                self.alive[idx[~mask]] = False
+                idx = idx[mask]
+                new_edge = new_edge[mask]
+                overflow = overflow[mask]
+                leaves_end = leaves_end[mask]
+                direction = direction[mask]
+
+            frac = overflow / edge_lens[new_edge]
+            self.edge[idx] = new_edge
+            self.pos[idx] = np.where(leaves_end, 1 - frac, frac)
+            self.speed[idx] = direction * np.abs(self.speed[idx])
+
+        # Kill any particle still not on an edge
+        idx = np.flatnonzero(self.alive)
+        stuck = (self.pos[idx] > 1) | (self.pos[idx] < 0)
+        self.alive[idx[stuck]] = False
+
+    def splat(self, out, brightness=1):
+        """
+        Add the color of every particle to the LED it is on
+        """
+
+        struct = self.struct
+        idx = np.flatnonzero(self.alive)
+        if len(idx) == 0:
+            return
+
+        edge = self.edge[idx]
+        lengths = struct.edge_lengths[edge]
+        local = np.minimum((self.pos[idx] * lengths).astype(np.intp), lengths - 1)
+        leds = struct.edge_starts[edge] + local
+
+        # Particles fade out over their lifetime
+        fade = 1 - self.age[idx] / self.life[idx]
+        fade *= brightness
+
+        # Unbuffered scatter, so that particles on the same LED add up
+        np.add.at(out, leds, self.color[idx] * fade[:, np.newaxis])
@@ -0,0 +1,336 @@
+"""
+Multi-process render pipeline. The animations are rendered in a worker
+process, so that heavy NumPy rendering doesn't compete with the audio
+analysis and LED output for the GIL of the main process. Rendered frames
+are passed back through a double buffer in shared memory, and the audio
+features are passed to the worker through the same shared memory.
+"""
+
+import time
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from stats import stats
+import beat
+
+# Layout of the shared frame buffer header (int64 words):
+# latest complete slot (-1 if none), sequence number of each slot,
+# generation of the frame in each slot, and sequence number of the
+# audio features
+HDR_LATEST = 0
+HDR_SEQ = 1
+HDR_GEN = 3
+HDR_FEAT_SEQ = 5
+HDR_WORDS = 8
+
+# Audio features block (float64 words): time of the features, then
+# the feature values
+FEAT_WORDS = 8
+assert 1 + beat.NUM_FEATURES <= FEAT_WORDS
+
+# Number of frames between updates of the worker's timing stats
+STATS_INTERVAL = 30
+
+class FrameBuffer:
+    """
+    Double buffer of frames in shared memory, written by one process and
+    read by another without copying.
+
+    Each slot has a sequence number (seqlock) that the writer makes odd
+    while it writes the slot and even once done. The writer always writes
+    the slot which isn't the latest, and readers check the sequence number
+    after using a frame, to detect frames torn by a concurrent write.
+
+    The audio features go the other way, from the reader to the writer,
+    with a sequence number of their own.
+    """
+
+    def __init__(self, num_leds, name=None):
+        size = HDR_WORDS * 8 + FEAT_WORDS * 8 + 2 * num_leds * 3 * 4
+
+        # The buffer is created by the reader, and attached to by name
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.num_leds = num_leds
+
+        self.header = np.ndarray(HDR_WORDS, dtype=np.int64, buffer=self.shm.buf)
+        self.features = np.ndarray(
+            FEAT_WORDS,
+            dtype=np.float64,
+            buffer=self.shm.buf,
+            offset=HDR_WORDS * 8
+        )
+        self.slots = np.ndarray(
+            (2, num_leds, 3),
+            dtype=np.float32,
+            buffer=self.shm.buf,
+            offset=(HDR_WORDS + FEAT_WORDS) * 8
+        )
+
+        if self.owner:
+            self.header[:] = 0
+            self.header[HDR_LATEST] = -1
+
+        # Number of reads retried because the frame was overwritten
+        self.torn = 0
+
+        # Sequence number of the last features read
+        self.feat_seq = 0
+
+    @property
+    def num_writes(self):
+        return int(self.header[HDR_SEQ] + self.header[HDR_SEQ + 1]) // 2
+
+    def write(self, pixels, generation):
+        """
+        Write a frame (writer side)
+        """
+
+        slot = 1 if self.header[HDR_LATEST] == 0 else 0
+        seq = HDR_SEQ + slot
+
+        self.header[seq] += 1
+        self.slots[slot] = pixels
+        self.header[HDR_GEN + slot] = generation
+        self.header[seq] += 1
+
+        self.header[HDR_LATEST] = slot
+
+    def begin_read(self):
+        """
+        Get a view of the latest complete frame, without copying.
+        Returns (frame, generation, token), or None if no frame was
+        written yet. The token must be passed to end_read once the
+        frame has been used, to check that it wasn't torn.
+        """
+
+        while True:
+            slot = int(self.header[HDR_LATEST])
+            if slot < 0:
+                return None
+
+            seq = int(self.header[HDR_SEQ + slot])
+            generation = int(self.header[HDR_GEN + slot])
+
+            # The writer lapped us and is writing this slot again
+            if seq & 1:
+                continue
+
+            return self.slots[slot], generation, (slot, seq)
+
+    def end_read(self, token):
+        """
+        Check that a frame obtained with begin_read wasn't overwritten
+        while it was being used
+        """
+
+        slot, seq = token
+        if self.header[HDR_SEQ + slot] == seq:
+            return True
+
+        self.torn += 1
+        return False
+
+    def read(self, out):
+        """
+        Copy the latest frame into a buffer, retrying if it gets torn.
+        Returns the generation of the frame, or None if no frame was
+        written yet.
+        """
+
+        while True:
+            latest = self.begin_read()
+            if latest is None:
+                return None
+
+            frame, generation, token = latest
+            out[:] = frame
+            if self.end_read(token):
+                return generation
+
+    def write_features(self, bus):
+        """
+        Publish the audio features of a feature bus (reader side)
+        """
+
+        seq = self.header[HDR_FEAT_SEQ]
+
+        self.header[HDR_FEAT_SEQ] = seq + 1
+        self.features[0] = bus.time
+        self.features[1:1+beat.NUM_FEATURES] = bus.values
+        self.header[HDR_FEAT_SEQ] = seq + 2
+
+    def read_features(self, bus):
+        """
+        Copy the latest audio features into a feature bus, if they
+        changed since the last read (writer side). Returns True if
+        they changed.
+        """
+
+        while True:
+            seq = int(self.header[HDR_FEAT_SEQ])
+            if seq == self.feat_seq:
+                return False
+
+            # The features are being written
+            if seq & 1:
+                continue
+
+            features = self.features.copy()
+            if self.header[HDR_FEAT_SEQ] == seq:
+                break
+
+        self.feat_seq = seq
+
+        bus.values[:] = features[1:1+beat.NUM_FEATURES]
+        bus.time = features[0]
+        bus.count += 1
+        return True
+
+    def close(self):
+        # Release the NumPy views before closing the shared memory
+        self.header = None
+        self.features = None
+        self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def render_worker(frames, commands, timings, anim_name, show_path):
+    """
+    Render loop of the worker process. Commands are tuples sent through
+    the queue: ('pulse', t), ('crossfade', anim_name, num_beats), ('stop',)
+    The summaries of the worker's timing histograms are sent back
+    through the timings queue periodically.
+    """
+
+    import structure
+    import animations
+    import show
+    from mixer import Mixer
+    from scheduler import FrameScheduler
+
+    anim = Mixer(structure.cube)
+
+    if show_path:
+        anim.add_layer(show.ShowAnimation, show.ShowReader(show_path))
+    else:
+        anim.add_layer(getattr(animations, anim_name))
+
+    num_ticks = 0
+
+    def tick(t):
+        nonlocal num_ticks
+
+        while True:
+            try:
+                cmd = commands.get_nowait()
+            except queue.Empty:
+                break
+
+            if cmd[0] == 'pulse':
+                anim.pulse(cmd[1])
+            elif cmd[0] == 'crossfade':
+                anim.crossfade(getattr(animations, cmd[1]), cmd[2])
+            elif cmd[0] == 'stop':
+                scheduler.stop()
+                return
+
+        frames.read_features(beat.features)
+
+        start = time.perf_counter()
+        if anim.render(t):
+            frames.write(anim.out, anim.generation)
+        stats.record('render', time.perf_counter() - start)
+
+        num_ticks += 1
+        if num_ticks % STATS_INTERVAL == 0:
+            timings.put({key: hist.summary() for key, hist in stats.hists.items()})
+
+    scheduler = FrameScheduler(tick)
+
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+class RenderProcess:
+    """
+    Animations rendered in a worker process. This has the same pulse and
+    crossfade methods as the mixer, and the frames are read from the
+    shared frame buffer. The audio features must be sent to the worker
+    at every frame, with send_features.
+
+    Note: the worker is forked, so this must be started before any
+    threads (eg: audio input) are started in the main process.
+    """
+
+    def __init__(self, num_leds, anim_name='', show_path=''):
+        self.frames = FrameBuffer(num_leds)
+
+        ctx = multiprocessing.get_context('fork')
+        self.commands = ctx.Queue()
+        self.timings_queue = ctx.Queue()
+        self.process = ctx.Process(
+            target=render_worker,
+            args=(self.frames, self.commands, self.timings_queue, anim_name, show_path),
+            daemon=True
+        )
+
+        # Feature bus update count at the last features sent
+        self.features_count = None
+
+        # Latest timing summaries of the worker
+        self.worker_timings = {}
+
+    def start(self):
+        self.process.start()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.commands.put(('stop',))
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.frames.close()
+
+    def pulse(self, t):
+        self.commands.put(('pulse', t))
+
+    def send_features(self):
+        """
+        Send the audio features to the worker, if they changed
+        """
+
+        if beat.features.count != self.features_count:
+            self.features_count = beat.features.count
+            self.frames.write_features(beat.features)
+
+    def crossfade(self, anim_class, num_beats):
+        self.commands.put(('crossfade', anim_class.__name__, num_beats))
+
+    def stats(self):
+        return {
+            'alive': self.process.is_alive(),
+            'frames': self.frames.num_writes,
+            'torn': self.frames.torn,
+        }
+
+    def timings(self):
+        """
+        Latest summaries of the worker's timing histograms, with the
+        keys prefixed with 'worker.'
+        """
+
+        while True:
+            try:
+                self.worker_timings = self.timings_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        return {'worker.' + key: summary for key, summary in self.worker_timings.items()}
@@ -0,0 +1,120 @@
+import time
+import numpy as np
+import animations
+
+class FrameScheduler:
+    """
+    Fixed rate frame scheduler. Frames are run at absolute deadlines on a
+    monotonic clock, so timing doesn't drift, and the lateness of every
+    frame is recorded. This doesn't depend on any GUI library, so it can
+    drive the animations headless on the Pi as well as in the simulator.
+    """
+
+    def __init__(
+        self,
+        tick,
+        rate=animations.UPDATE_RATE,
+        skip=True,
+        clock=time.monotonic,
+        history=1024
+    ):
+        # Function called for each frame, with the frame deadline
+        self.tick = tick
+
+        # Time between frames (in seconds)
+        self.period = 1 / rate
+
+        # If true, frames which are over one period late are skipped
+        # instead of being run back to back to catch up
+        self.skip = skip
+
+        self.clock = clock
+
+        # Time of the first frame
+        self.start_time = None
+
+        # Index of the next frame to run
+        self.frame_idx = 0
+
+        # Ring buffer of the lateness of the last frames (in seconds)
+        self.lateness = np.zeros(history)
+
+        # Number of frames run, frames skipped, and frames run late
+        # by more than one period
+        self.num_frames = 0
+        self.num_skipped = 0
+        self.num_missed = 0
+
+        self.running = False
+
+    @property
+    def next_deadline(self):
+        return self.start_time + self.frame_idx * self.period
+
+    def poll(self):
+        """
+        Run the next frame if it is due, without blocking.
+        Returns the time left until the next deadline.
+        """
+
+        now = self.clock()
+
+        if self.start_time is None:
+            self.start_time = now
+
+        deadline = self.next_deadline
+        if now < deadline:
+            return deadline - now
+
+        late = now - deadline
+
+        if late >= self.period:
+            self.num_missed += 1
+
+            if self.skip:
+                num_skipped = int(late // self.period)
+                self.frame_idx += num_skipped
+                self.num_skipped += num_skipped
+                deadline = self.next_deadline
+                late = now - deadline
+
+        self.lateness[self.num_frames % len(self.lateness)] = late
+        self.num_frames += 1
+        self.frame_idx += 1
+
+        self.tick(deadline)
+
+        return max(0, self.next_deadline - self.clock())
+
+    def run(self):
+        """
+        Run frames until stop() is called
+        """
+
+        self.running = True
+
+        while self.running:
+            delay = self.poll()
+            if delay > 0:
+                time.sleep(delay)
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        """
+        Get the frame counters and lateness percentiles (in milliseconds)
+        """
+
+        count = min(self.num_frames, len(self.lateness))
+        lateness = self.lateness[:count] if count else np.zeros(1)
+        p50, p99 = 1000 * np.percentile(lateness, [50, 99])
+
+        return {
+            'frames': self.num_frames,
+            'skipped': self.num_skipped,
+            'missed': self.num_missed,
+            'late_p50_ms': float(p50),
+            'late_p99_ms': float(p99),
+            'late_max_ms': float(1000 * lateness.max()),
+        }
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+"""
+Serial LED output, for a microcontroller (eg: Teensy, ESP32) connected
+over USB serial, which takes care of the LED timing. Each frame is sent
+as one COBS-framed packet with a sequence number and a CRC32, in one
+bulk write on a non-blocking file descriptor. When the link is slower
+than the frame rate, the oldest unsent frame is dropped.
+
+Packet format, before COBS encoding (little endian):
+    sequence number (u16), number of LEDs (u16), RGB bytes, CRC32 (u32)
+The CRC covers everything before it. Encoded packets end with a zero byte.
+"""
+
+import os
+import sys
+import tty
+import time
+import zlib
+import errno
+import select
+import struct
+import argparse
+import numpy as np
+from stats import stats
+
+HEADER_FORMAT = '<HH'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+CRC_SIZE = 4
+
+# Largest COBS block, 254 data bytes after the code byte
+COBS_BLOCK = 254
+
+def cobs_encode(data):
+    """
+    COBS-encode a uint8 array, without a Python loop over the bytes.
+
+    Each run of non-zero bytes is split into full blocks of 254 bytes
+    (code 0xFF, no zero implied) followed by one last block with a code
+    of its length plus one, which implies the zero ending the run. The
+    end of the data counts as a zero, which the decoder drops.
+    """
+
+    data = np.asarray(data, dtype=np.uint8).reshape(-1)
+    is_zero = data == 0
+
+    # Runs of non-zero bytes, each ended by a zero or the end
+    ends = np.concatenate([np.flatnonzero(is_zero), [len(data)]])
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    lengths = ends - starts
+
+    num_full = lengths // COBS_BLOCK
+    num_blocks = num_full + 1
+    out_lengths = lengths + num_blocks
+    out_starts = np.cumsum(out_lengths) - out_lengths
+
+    out = np.empty(int(out_lengths.sum()), dtype=np.uint8)
+
+    # Code bytes, 0xFF for the full blocks, and the
+    # length plus one for the last block of each run
+    block_run = np.repeat(np.arange(len(starts)), num_blocks)
+    block_idx = np.arange(len(block_run)) - np.repeat(np.cumsum(num_blocks) - num_blocks, num_blocks)
+    codes = np.where(
+        block_idx < num_full[block_run],
+        0xFF,
+        lengths[block_run] - COBS_BLOCK * num_full[block_run] + 1
+    )
+    out[out_starts[block_run] + block_idx * (COBS_BLOCK + 1)] = codes
+
+    # Data bytes, after the code byte of their block
+    pos = np.flatnonzero(~is_zero)
+    run = np.cumsum(is_zero)[pos]
+    local = pos - starts[run]
+    out[out_starts[run] + local + local // COBS_BLOCK + 1] = data[pos]
+
+    return out
+
+def cobs_decode(buf):
+    """
+    Decode one COBS-encoded packet (without the zero delimiter).
+    Returns the decoded bytes, or None if the packet is malformed.
+    """
+
+    out = bytearray()
+    pos = 0
+
+    while pos < len(buf):
+        code = buf[pos]
+        end = pos + code
+        if code == 0 or end > len(buf):
+            return None
+
+        out += buf[pos+1:end]
+        pos = end
+
+        if code != 0xFF:
+            out.append(0)
+
+    # The last block implies the zero ending the data
+    if not out or out[-1] != 0:
+        return None
+    return bytes(out[:-1])
+
+def encode_frame(packed, seq):
+    """
+    Build the encoded packet of a frame, including the zero delimiter
+    """
+
+    num_leds = len(packed)
+    payload = np.empty(HEADER_SIZE + 3 * num_leds + CRC_SIZE, dtype=np.uint8)
+
+    struct.pack_into(HEADER_FORMAT, payload, 0, seq, num_leds)
+    payload[HEADER_SIZE:-CRC_SIZE] = packed.reshape(-1)
+    crc = zlib.crc32(payload[:-CRC_SIZE])
+    struct.pack_into('<I', payload, len(payload) - CRC_SIZE, crc)
+
+    return cobs_encode(payload).tobytes() + b'\x00'
+
+def decode_frame(packet):
+    """
+    Decode an encoded packet (without the zero delimiter). Returns the
+    sequence number and the (num_leds, 3) RGB bytes, or None if the
+    packet is malformed or corrupted.
+    """
+
+    payload = cobs_decode(packet)
+    if payload is None or len(payload) < HEADER_SIZE + CRC_SIZE:
+        return None
+
+    seq, num_leds = struct.unpack_from(HEADER_FORMAT, payload)
+    if len(payload) != HEADER_SIZE + 3 * num_leds + CRC_SIZE:
+        return None
+
+    crc, = struct.unpack_from('<I', payload, len(payload) - CRC_SIZE)
+    if zlib.crc32(payload[:-CRC_SIZE]) != crc:
+        return None
+
+    rgb = np.frombuffer(payload, dtype=np.uint8, count=3*num_leds, offset=HEADER_SIZE)
+    return seq, rgb.reshape(-1, 3)
+
+class SerialSink:
+    """
+    LED sink writing COBS-framed packets to a serial device. The device
+    is non-blocking, so a slow link never blocks the frame loop: a frame
+    partially written is finished on the next writes, and only the latest
+    frame waits behind it, older waiting frames are dropped.
+    """
+
+    def __init__(self, path, num_leds):
+        self.path = path
+        self.num_leds = num_leds
+
+        # The packets hold RGB bytes, the controller reorders them
+        # for its LEDs if needed
+        self.order = 'RGB'
+
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        if os.isatty(self.fd):
+            tty.setraw(self.fd)
+
+        self.seq = 0
+
+        # Encoded frame being written, and how much of it was written
+        self.pending = None
+        self.pending_pos = 0
+
+        # Latest encoded frame, waiting for the pending one to be written
+        self.queued = None
+
+        self.num_frames = 0
+        self.num_dropped = 0
+        self.num_bytes = 0
+
+    def write(self, packed):
+        self.seq = (self.seq + 1) & 0xFFFF
+        packet = encode_frame(packed, self.seq)
+
+        start = time.perf_counter()
+
+        # Drop the oldest frame still waiting
+        if self.queued is not None:
+            self.num_dropped += 1
+        self.queued = packet
+
+        self.flush()
+        stats.record('serial.write', time.perf_counter() - start)
+
+    def poll(self):
+        """
+        Called between frames when nothing changed, to finish writing
+        the last frames
+        """
+        self.flush()
+
+    def flush(self):
+        """
+        Write as much as the link takes, with one write per frame.
+        Returns True if nothing is left to write.
+        """
+
+        while True:
+            if self.pending is None:
+                if self.queued is None:
+                    return True
+                self.pending = memoryview(self.queued)
+                self.pending_pos = 0
+                self.queued = None
+
+            try:
+                n = os.write(self.fd, self.pending[self.pending_pos:])
+            except BlockingIOError:
+                return False
+
+            self.pending_pos += n
+            self.num_bytes += n
+
+            if self.pending_pos < len(self.pending):
+                return False
+
+            self.pending = None
+            self.num_frames += 1
+
+    def close(self):
+        os.close(self.fd)
+
+    def stats(self):
+        return {
+            'frames': self.num_frames,
+            'dropped': self.num_dropped,
+            'bytes': self.num_bytes,
+        }
+
+class SerialReceiver:
+    """
+    Receiving end of a serial link, standing in for the microcontroller.
+    Splits the byte stream on zero bytes and decodes the packets.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = bytearray()
+
+        self.num_frames = 0
+        self.num_corrupted = 0
+
+        # Number of frames missing, from the sequence numbers
+        self.num_missing = 0
+        self.seq = None
+
+    def receive(self, on_frame, timeout=None):
+        """
+        Read the available bytes, waiting up to the timeout for some,
+        and call on_frame with the sequence number and RGB bytes of
+        each complete frame. Returns False once the link is closed.
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return True
+
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError as e:
+            # The other end of a pty was closed
+            if e.errno == errno.EIO:
+                return False
+            raise
+
+        if not data:
+            return False
+        self.buf += data
+
+        while True:
+            end = self.buf.find(0)
+            if end < 0:
+                break
+
+            packet = bytes(self.buf[:end])
+            del self.buf[:end+1]
+
+            if not packet:
+                continue
+
+            frame = decode_frame(packet)
+            if frame is None:
+                self.num_corrupted += 1
+                continue
+
+            seq, rgb = frame
+            if self.seq is not None:
+                self.num_missing += (seq - self.seq - 1) & 0xFFFF
+            self.seq = seq
+            self.num_frames += 1
+            on_frame(seq, rgb)
+
+        return True
+
+def open_pty():
+    """
+    Create a pseudo-terminal standing in for a serial device. Returns
+    the receiver on the master side, and the path of the slave side to
+    open the sink on.
+    """
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    path = os.ttyname(slave)
+
+    # Keep the slave open, so the master doesn't see the
+    # link closed while the sink isn't open yet
+    receiver = SerialReceiver(master)
+    receiver.slave_fd = slave
+
+    return receiver, path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='stand-in for the serial LED controller, on a pseudo-terminal')
+    parser.add_argument('--path', type=str, default='', help='serial device to read instead of creating a pseudo-terminal')
+    args = parser.parse_args()
+
+    if args.path:
+        fd = os.open(args.path, os.O_RDWR | os.O_NOCTTY)
+        if os.isatty(fd):
+            tty.setraw(fd)
+        receiver = SerialReceiver(fd)
+    else:
+        receiver, path = open_pty()
+        print('Listening on', path)
+        print('Run: python3 main.py --output serial:' + path)
+
+    def on_frame(seq, rgb):
+        print('\rframe {:5} seq {:5}, corrupted {}, missing {}, max {:3}'.format(
+            receiver.num_frames,
+            seq,
+            receiver.num_corrupted,
+            receiver.num_missing,
+            rgb.max()
+        ), end='')
+        sys.stdout.flush()
+
+    try:
+        while receiver.receive(on_frame, 1):
+            pass
+    except KeyboardInterrupt:
+        print()
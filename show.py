@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+"""
+Recorded shows. The frames produced by an animation are stored in a
+compact binary file (uint8 RGB, optionally run-length or delta encoded)
+which can be replayed at near-zero CPU cost, eg: to play sequences
+pre-rendered on a laptop on the Pi, or to debug a recorded night in
+the simulator.
+
+File layout:
+- header (HEADER_SIZE bytes, see HEADER_FORMAT)
+- frame payloads, back to back
+- frame index (one INDEX_DTYPE record per frame)
+"""
+
+import struct
+import argparse
+import numpy as np
+import animations
+from beat import beat_track
+
+MAGIC = b'LEDSHOW1'
+VERSION = 1
+
+# Magic, version, number of LEDs, compression, number of frames, index offset
+HEADER_FORMAT = '<8sIIIQQ'
+HEADER_SIZE = 64
+
+# Compression modes
+COMPRESSION = {'none': 0, 'rle': 1, 'delta': 2}
+
+# Kinds of frame payloads
+FRAME_RAW = 0
+FRAME_RLE = 1
+FRAME_DELTA = 2
+FRAME_REPEAT = 3
+
+INDEX_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('offset', '<u8'),
+    ('size', '<u4'),
+    ('kind', '<u4'),
+])
+
+def to_uint8(pixels, out, scratch):
+    """
+    Convert float pixels to uint8 RGB, clipping values outside [0, 1]
+    """
+
+    np.clip(pixels.reshape(-1, 3), 0, 1, out=scratch)
+    scratch *= 255
+    np.rint(scratch, out=scratch)
+    np.copyto(out, scratch, casting='unsafe')
+
+def rle_encode(rgb):
+    """
+    Run-length encode (num_leds, 3) uint8 pixels. The payload is the
+    number of runs (uint32), the run lengths (uint16) and the run colors.
+    """
+
+    changes = np.any(rgb[1:] != rgb[:-1], axis=1)
+    starts = np.flatnonzero(np.concatenate([[True], changes]))
+    lengths = np.diff(np.append(starts, len(rgb))).astype('<u2')
+
+    return b''.join([
+        struct.pack('<I', len(starts)),
+        lengths.tobytes(),
+        rgb[starts].tobytes(),
+    ])
+
+def rle_decode(payload, out):
+    """
+    Decode a run-length encoded payload into (num_leds, 3) uint8 pixels
+    """
+
+    num_runs = int(np.frombuffer(payload[:4], dtype='<u4')[0])
+    lengths = np.frombuffer(payload[4:4+2*num_runs], dtype='<u2')
+    colors = np.frombuffer(payload[4+2*num_runs:], dtype=np.uint8).reshape(-1, 3)
+    out[:] = np.repeat(colors, lengths, axis=0)
+
+class ShowWriter:
+    """
+    Record frames into a show file
+    """
+
+    def __init__(self, path, num_leds, compression='none', keyframe_interval=30):
+        assert num_leds < 65536 or compression == 'none'
+
+        self.file = open(path, 'wb')
+        self.num_leds = num_leds
+        self.compression = compression
+
+        # With delta compression, a full frame is stored every
+        # keyframe_interval frames so replay can seek quickly
+        self.keyframe_interval = keyframe_interval
+
+        self.index = []
+        self.offset = HEADER_SIZE
+
+        # Current and previous frame, as uint8 RGB
+        self.rgb = np.zeros((num_leds, 3), dtype=np.uint8)
+        self.prev = np.zeros((num_leds, 3), dtype=np.uint8)
+        self.xor = np.zeros((num_leds, 3), dtype=np.uint8)
+        self.scratch = np.zeros((num_leds, 3), dtype=np.float32)
+
+        # Generation of the last frame written, if known
+        self.generation = None
+
+        self.file.write(bytes(HEADER_SIZE))
+
+    def write(self, pixels, t, generation=None):
+        """
+        Record a frame of float pixels, shown at time t. If the frame
+        has the same generation as the last one written, it is recorded
+        as a repeat without being converted or compared.
+        """
+
+        frame_idx = len(self.index)
+
+        if frame_idx > 0 and generation is not None and generation == self.generation:
+            self.index.append((t, self.offset, 0, FRAME_REPEAT))
+            return
+        self.generation = generation
+
+        to_uint8(pixels, self.rgb, self.scratch)
+
+        if frame_idx > 0 and np.array_equal(self.rgb, self.prev):
+            kind, payload = FRAME_REPEAT, b''
+        elif self.compression == 'none':
+            kind, payload = FRAME_RAW, self.rgb.tobytes()
+        elif self.compression == 'rle' or frame_idx % self.keyframe_interval == 0:
+            kind, payload = FRAME_RLE, rle_encode(self.rgb)
+        else:
+            np.bitwise_xor(self.rgb, self.prev, out=self.xor)
+            kind, payload = FRAME_DELTA, rle_encode(self.xor)
+
+        self.file.write(payload)
+        self.index.append((t, self.offset, len(payload), kind))
+        self.offset += len(payload)
+
+        self.prev[:] = self.rgb
+
+    def close(self):
+        index = np.array(self.index, dtype=INDEX_DTYPE)
+        self.file.write(index.tobytes())
+
+        header = struct.pack(
+            HEADER_FORMAT,
+            MAGIC,
+            VERSION,
+            self.num_leds,
+            COMPRESSION[self.compression],
+            len(index),
+            self.offset
+        )
+        self.file.seek(0)
+        self.file.write(header)
+        self.file.close()
+
+class ShowReader:
+    """
+    Memory-mapped show file reader
+    """
+
+    def __init__(self, path):
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+
+        magic, version, num_leds, _, num_frames, index_offset = struct.unpack(
+            HEADER_FORMAT,
+            self.data[:struct.calcsize(HEADER_FORMAT)].tobytes()
+        )
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a show file: ' + path)
+
+        self.num_leds = num_leds
+        self.num_frames = num_frames
+
+        end = index_offset + num_frames * INDEX_DTYPE.itemsize
+        self.index = self.data[index_offset:end].view(INDEX_DTYPE)
+        self.times = self.index['time']
+
+        # Last decoded frame, as uint8 RGB
+        self.rgb = np.zeros((num_leds, 3), dtype=np.uint8)
+        self.xor = np.zeros((num_leds, 3), dtype=np.uint8)
+        self.frame_idx = -1
+
+    @property
+    def duration(self):
+        return self.times[-1] if self.num_frames else 0
+
+    def frame_at(self, t):
+        """
+        Index of the frame shown at time t
+        """
+        return max(0, int(np.searchsorted(self.times, t, side='right')) - 1)
+
+    def decode(self, frame_idx):
+        """
+        Decode a frame, returns (num_leds, 3) uint8 pixels
+        """
+
+        if frame_idx == self.frame_idx:
+            return self.rgb
+
+        # Delta frames depend on the previous frames, so we may have
+        # to rewind to the last keyframe before decoding
+        start = frame_idx
+        if frame_idx < self.frame_idx or frame_idx > self.frame_idx + 1:
+            while start > 0 and self.index[start]['kind'] in (FRAME_DELTA, FRAME_REPEAT):
+                start -= 1
+        else:
+            start = self.frame_idx + 1
+
+        for idx in range(start, frame_idx + 1):
+            self._decode_one(idx)
+
+        self.frame_idx = frame_idx
+        return self.rgb
+
+    def _decode_one(self, frame_idx):
+        entry = self.index[frame_idx]
+        offset = int(entry['offset'])
+        payload = self.data[offset:offset+int(entry['size'])]
+        kind = entry['kind']
+
+        if kind == FRAME_RAW:
+            self.rgb[:] = payload.reshape(-1, 3)
+        elif kind == FRAME_RLE:
+            rle_decode(payload, self.rgb)
+        elif kind == FRAME_DELTA:
+            rle_decode(payload, self.xor)
+            np.bitwise_xor(self.rgb, self.xor, out=self.rgb)
+
+    def read(self, frame_idx, out):
+        """
+        Decode a frame into a float pixel buffer
+        """
+
+        rgb = self.decode(frame_idx)
+        np.multiply(rgb, 1 / 255, out=out.reshape(-1, 3))
+
+class ShowAnimation(animations.Animation):
+    """
+    Replay a recorded show as an animation
+    Note: this is not registered with the other animations since
+    it needs a show file
+    """
+
+    def __init__(self, struct, reader, out=None):
+        super().__init__(struct, out)
+        assert reader.num_leds * 3 == self.out.size
+
+        self.reader = reader
+        self.start_time = None
+
+        # Index of the frame in the output buffer
+        self.frame_idx = -1
+
+    def update(self, t):
+        if self.start_time is None:
+            self.start_time = t
+
+        frame_idx = self.reader.frame_at(t - self.start_time)
+        if frame_idx == self.frame_idx:
+            return False
+
+        self.reader.read(frame_idx, self.out)
+        self.frame_idx = frame_idx
+
+def record(path, anim_class, struct, duration, compression):
+    """
+    Pre-render an animation into a show file, using a simulated clock
+    and a synthetic beat track
+    """
+
+    anim = anim_class(struct)
+    writer = ShowWriter(path, struct.num_leds, compression)
+
+    beats = beat_track(duration)
+    beat_idx = 0
+
+    num_frames = int(duration * animations.UPDATE_RATE)
+
+    for frame_idx in range(num_frames):
+        t = frame_idx * animations.UPDATE_TIME
+
+        while beat_idx < len(beats) and beats[beat_idx] <= t:
+            anim.pulse(t)
+            beat_idx += 1
+
+        anim.render(t)
+        writer.write(anim.out, t, anim.generation)
+
+    writer.close()
+
+if __name__ == '__main__':
+    import os
+    import structure
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help='pre-render an animation')
+    record_parser.add_argument('path')
+    record_parser.add_argument('--anim', type=str, required=True)
+    record_parser.add_argument('--duration', type=float, default=60, help='length of the show (seconds)')
+    record_parser.add_argument('--compression', choices=list(COMPRESSION), default='delta')
+
+    info_parser = subparsers.add_parser('info', help='describe a show file')
+    info_parser.add_argument('path')
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        anim_class = getattr(animations, args.anim)
+        record(args.path, anim_class, structure.cube, args.duration, args.compression)
+
+    reader = ShowReader(args.path)
+    print('{}: {} LEDs, {} frames, {:.1f}s, {:.1f} KB'.format(
+        args.path,
+        reader.num_leds,
+        reader.num_frames,
+        reader.duration,
+        os.path.getsize(args.path) / 1024
+    ))
@@ -1,17 +1,27 @@
 #!/usr/bin/env python3
 
-import time
 import argparse
 import math
+import ctypes
+import numpy as np
 import pyglet
 from pyglet.gl import *
 from pyglet.window import key
 from pyglet.window import mouse
+import random
 import structure
 import animations
+from mixer import Mixer
+from scheduler import FrameScheduler
+from beat import TempoTracker
+from delta import DeltaEncoder, DeltaDecoder, DeltaFrame
+import show
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--anim", type=str, default='', help='test a specific animation')
+parser.add_argument("--show", type=str, default='', help='replay a recorded show file')
+parser.add_argument("--tempo-tracker", action='store_true', help='schedule pulses from the tempo tracker')
+parser.add_argument("--delta", action='store_true', help='show the frames after delta encoding and decoding')
 args = parser.parse_args()
 
 window = pyglet.window.Window(
@@ -20,11 +30,16 @@ window = pyglet.window.Window(
     caption='LEDBurn Simulator'
 )
 
-if args.anim:
-    anim_class = getattr(animations, args.anim)
-    anim = anim_class(structure.cube)
+# All animations are rendered through the mixer, so that we
+# can crossfade between them
+anim = Mixer(structure.cube)
+
+if args.show:
+    anim.add_layer(show.ShowAnimation, show.ShowReader(args.show))
+elif args.anim:
+    anim.add_layer(getattr(animations, args.anim))
 else:
-    anim = animations.TestSequence(structure.cube)
+    anim.add_layer(animations.TestSequence)
 
 # Time when the next beat should occur
 next_beat = 0
@@ -32,6 +47,24 @@ next_beat = 0
 # Number of beats so far
 num_beats = 0
 
+def on_pulse(t):
+    anim.pulse(t)
+
+# The synthetic beats can be used as a test signal for the tempo tracker
+tracker = TempoTracker(on_pulse) if args.tempo_tracker else None
+
+# Frames shown, either the rendered frames, or the frames decoded at
+# the end of a loopback delta encoded link
+display = structure.cube.pixels
+
+if args.delta:
+    num_leds = structure.cube.num_leds
+    encoder = DeltaEncoder(num_leds)
+    decoder = DeltaDecoder(num_leds)
+    rgb = np.zeros((num_leds, 3), dtype=np.uint8)
+    rgb_scratch = np.zeros((num_leds, 3), dtype=np.float32)
+    display = np.zeros_like(structure.cube.pixels)
+
 @window.event
 def on_key_press(symbol, modifiers):
     print('A key was pressed')
@@ -68,57 +101,97 @@ def on_draw():
         0
     )
 
-    draw_struct(structure.cube)
+    renderer.draw(display, anim.generation)
 
-def draw_struct(struct):
+def make_buffer(data, usage):
+    """
+    Create an OpenGL vertex buffer and upload a float32 array into it
     """
-    Draw a structure and its LEDs
+
+    buf = GLuint()
+    glGenBuffers(1, ctypes.byref(buf))
+    glBindBuffer(GL_ARRAY_BUFFER, buf)
+    glBufferData(GL_ARRAY_BUFFER, data.nbytes, data.ctypes.data, usage)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    return buf
+
+class StructRenderer:
+    """
+    Draw a structure and its LEDs using vertex buffers.
+    The geometry is uploaded once, and only the LED colors are streamed
+    to the GPU every frame, in a single bulk copy.
     Note: we define the drawing code here because we don't want to import
     the pyglet dependencies in the rest of the code.
     """
 
-    glColor3f(1, 1, 1)
-    glPointSize(5)
-    glBegin(GL_POINTS)
-    for vert in struct.verts:
-        glVertex3f(*vert.pos)
-    glEnd(GL_POINTS)
-
-    glColor3f(0.2, 0.2, 0.2)
-    glBegin(GL_LINES)
-    for edge in struct.edges:
-        p0 = edge.start.pos
-        p1 = edge.end.pos
-        glVertex3f(*p0)
-        glVertex3f(*p1)
-    glEnd(GL_LINES)
-
-    struct = structure.cube
-    pixels = struct.pixels
-    poss = struct.poss
-
-    # TODO: draw colored OpenGL points for the LEDs
-    glColor3f(1, 1, 1)
-    glPointSize(2)
-    glBegin(GL_POINTS)
-
-    for edge_idx in range(pixels.shape[0]):
-        for led_idx in range(pixels.shape[1]):
-            c = pixels[edge_idx, led_idx]
-            p = poss[edge_idx, led_idx]
-            glColor3f(*c)
-            glVertex3f(*p)
-
-    glEnd(GL_POINTS)
-
-def update(dt):
-    global anim
+    def __init__(self, struct):
+        self.struct = struct
+
+        verts = np.array([v.pos for v in struct.verts], dtype=np.float32)
+        lines = np.array(
+            [[e.start.pos, e.end.pos] for e in struct.edges],
+            dtype=np.float32
+        )
+        poss = np.ascontiguousarray(struct.poss, dtype=np.float32)
+
+        self.num_verts = len(verts)
+        self.num_line_verts = 2 * len(lines)
+        self.num_leds = poss.size // 3
+
+        # Static buffers, these never change
+        self.vert_buf = make_buffer(verts, GL_STATIC_DRAW)
+        self.line_buf = make_buffer(lines, GL_STATIC_DRAW)
+        self.pos_buf = make_buffer(poss, GL_STATIC_DRAW)
+
+        # Color buffer, streamed when the frame changes
+        self.color_buf = make_buffer(struct.pixels, GL_STREAM_DRAW)
+
+        # Generation of the frame in the color buffer
+        self.generation = None
+
+    def draw(self, pixels, generation=None):
+        """
+        Draw the structure with the given LED colors. The colors are only
+        uploaded if the frame generation changed since the last draw.
+        """
+
+        assert pixels.flags.c_contiguous
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+
+        glColor3f(1, 1, 1)
+        glPointSize(5)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vert_buf)
+        glVertexPointer(3, GL_FLOAT, 0, 0)
+        glDrawArrays(GL_POINTS, 0, self.num_verts)
+
+        glColor3f(0.2, 0.2, 0.2)
+        glBindBuffer(GL_ARRAY_BUFFER, self.line_buf)
+        glVertexPointer(3, GL_FLOAT, 0, 0)
+        glDrawArrays(GL_LINES, 0, self.num_line_verts)
+
+        # Upload the LED colors in one bulk copy
+        glBindBuffer(GL_ARRAY_BUFFER, self.color_buf)
+        if generation is None or generation != self.generation:
+            glBufferSubData(GL_ARRAY_BUFFER, 0, pixels.nbytes, pixels.ctypes.data)
+            self.generation = generation
+        glColorPointer(3, GL_FLOAT, 0, 0)
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.pos_buf)
+        glVertexPointer(3, GL_FLOAT, 0, 0)
+
+        glEnableClientState(GL_COLOR_ARRAY)
+        glPointSize(2)
+        glDrawArrays(GL_POINTS, 0, self.num_leds)
+        glDisableClientState(GL_COLOR_ARRAY)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glDisableClientState(GL_VERTEX_ARRAY)
+
+def update(t):
     global next_beat
     global num_beats
 
-    # Get the current time in seconds
-    t = time.time()
-
     # Slowly vary the tempo over time so we can test animations more robustly
     bpm = 120 + 30 * math.sin(t / 40)
     beats_per_sec = bpm / 60
@@ -131,18 +204,37 @@ def update(dt):
         else:
             next_beat = t + secs_per_beat
 
-        anim.pulse(t)
+        if tracker:
+            tracker.onset(t)
+        else:
+            anim.pulse(t)
         print('Pulse! #{} tempo={:.1f} t={:.1f}'.format(num_beats, bpm, t))
         num_beats += 1
 
         # Randomly pick the next animation
-        if num_beats % 20 == 0 and not args.anim:
-            anim = animations.random_animation(structure.cube)
-            print('Next animation:', anim.__class__.__name__)
-
-    anim.update(t)
-
-
-pyglet.clock.schedule_interval(update, animations.UPDATE_TIME)
+        if num_beats % 20 == 0 and not (args.anim or args.show):
+            anim_class = random.choice(animations.animations)
+            anim.crossfade(anim_class, 4)
+            print('Next animation:', anim_class.__name__)
+            if args.delta:
+                print('Delta encoding stats:', encoder.stats())
+
+    if tracker:
+        tracker.poll(t)
+
+    if anim.render(t) and args.delta:
+        show.to_uint8(anim.out, rgb, rgb_scratch)
+        msg = encoder.encode(rgb).to_bytes()
+        decoder.apply(DeltaFrame.from_bytes(msg))
+        np.multiply(decoder.rgb, 1 / 255, out=display)
+
+
+# Renderer for the structure, created once the GL context exists
+renderer = StructRenderer(structure.cube)
+
+# Frames are run by the frame scheduler, which pyglet polls
+# more often than the frame rate
+scheduler = FrameScheduler(update)
+pyglet.clock.schedule_interval(lambda dt: scheduler.poll(), animations.UPDATE_TIME / 4)
 
 pyglet.app.run()
@@ -0,0 +1,114 @@
+import numpy as np
+
+class SpatialGrid:
+    """
+    Uniform grid over the LED positions, to find the LEDs near a point
+    without computing the distance to every LED of the structure.
+
+    The LED indices are sorted by grid cell, and each cell is a range
+    of that sorted array (compressed sparse row format), so queries
+    only gather the LEDs in the cells overlapping the query sphere.
+    """
+
+    def __init__(self, poss, cell_size=None):
+        self.poss = poss
+        num_leds = len(poss)
+
+        self.lo = poss.min(axis=0) if num_leds else np.zeros(3, dtype=np.float32)
+        hi = poss.max(axis=0) if num_leds else np.zeros(3, dtype=np.float32)
+
+        # Diagonal and volume of the bounding box of the LEDs
+        self.extent = float(np.linalg.norm(hi - self.lo))
+        size = np.maximum(hi - self.lo, 1e-3)
+        self.volume = float(np.prod(size))
+
+        # By default, aim for about one LED per cell
+        if cell_size is None:
+            cell_size = float(np.prod(size) / max(num_leds, 1)) ** (1 / 3)
+            cell_size = max(cell_size, float(size.max()) / 256)
+        self.cell_size = cell_size
+
+        self.shape = np.floor((hi - self.lo) / cell_size).astype(np.intp) + 1
+        num_cells = int(np.prod(self.shape))
+
+        # Sort the LEDs by cell
+        cells = self.cell_ids(self.cell_coords(poss))
+        self.order = np.argsort(cells, kind='stable').astype(np.intp)
+        counts = np.bincount(cells, minlength=num_cells)
+        self.cell_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.intp)
+
+    def cell_coords(self, poss):
+        coords = np.floor((poss - self.lo) / self.cell_size).astype(np.intp)
+        return np.clip(coords, 0, self.shape - 1)
+
+    def cell_ids(self, coords):
+        nx, ny, nz = self.shape
+        return (coords[..., 0] * ny + coords[..., 1]) * nz + coords[..., 2]
+
+    def candidates(self, pos, radius):
+        """
+        Get the indices of the LEDs in the cells overlapping a sphere
+        """
+
+        pos = np.asarray(pos, dtype=np.float32)
+        c0 = self.cell_coords(pos - radius)
+        c1 = self.cell_coords(pos + radius)
+
+        xs = np.arange(c0[0], c1[0] + 1)
+        ys = np.arange(c0[1], c1[1] + 1)
+        zs = np.arange(c0[2], c1[2] + 1)
+        nx, ny, nz = self.shape
+        cells = ((xs[:, None, None] * ny + ys[None, :, None]) * nz + zs[None, None, :]).reshape(-1)
+
+        starts = self.cell_starts[cells]
+        lengths = self.cell_starts[cells + 1] - starts
+        total = int(lengths.sum())
+
+        # Concatenate the cell ranges without a Python loop
+        offsets = np.cumsum(lengths) - lengths
+        idx = np.arange(total) + np.repeat(starts - offsets, lengths)
+
+        return self.order[idx]
+
+    def query_radius(self, pos, radius, return_dist2=False):
+        """
+        Get the indices of the LEDs within some distance of a point,
+        and optionally their squared distances to the point
+        """
+
+        leds = self.candidates(pos, radius)
+
+        delta = self.poss[leds] - np.asarray(pos, dtype=np.float32)
+        dist2 = np.einsum('ij,ij->i', delta, delta)
+        inside = dist2 <= radius * radius
+
+        if return_dist2:
+            return leds[inside], dist2[inside]
+        return leds[inside]
+
+    def knn(self, pos, k, return_dist2=False):
+        """
+        Get the indices of the k LEDs nearest to a point, closest first,
+        and optionally their squared distances to the point
+        """
+
+        k = min(k, len(self.poss))
+        if k == 0:
+            leds = np.zeros(0, dtype=np.intp)
+            return (leds, np.zeros(0, dtype=np.float32)) if return_dist2 else leds
+
+        # Grow the search radius until the sphere holds k LEDs,
+        # at the latest once it holds the whole bounding box
+        max_radius = self.extent + np.linalg.norm(np.asarray(pos) - self.lo)
+        radius = self.cell_size
+        while True:
+            leds, dist2 = self.query_radius(pos, radius, return_dist2=True)
+            if len(leds) >= k or radius > max_radius:
+                break
+            radius *= 2
+
+        nearest = np.argsort(dist2, kind='stable')[:k]
+
+        if return_dist2:
+            return leds[nearest], dist2[nearest]
+        return leds[nearest]
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Low-overhead timing instrumentation for the hot paths (animation
+updates and pulses, audio analysis, output writes). Timings are kept in
+log-spaced histograms and published periodically to a JSON stats file
+or a Unix datagram socket, so frame budgets can be watched live on the
+Pi without attaching a profiler.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import socket
+import threading
+import argparse
+
+# Histogram buckets per octave, and number of buckets. The first bucket
+# starts at 1 microsecond and the last one ends around 4 seconds.
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = 22 * BUCKETS_PER_OCTAVE
+
+class Histogram:
+    """
+    Log-spaced histogram of durations
+    """
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        us = seconds * 1e6
+        if us > 1:
+            bucket = min(int(BUCKETS_PER_OCTAVE * math.log2(us)), NUM_BUCKETS - 1)
+        else:
+            bucket = 0
+
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        Approximate percentile (in seconds), the upper bound of the
+        bucket the percentile falls in
+        """
+
+        rank = p / 100 * self.count
+        acc = 0
+
+        for bucket, count in enumerate(self.counts):
+            acc += count
+            if count and acc >= rank:
+                upper = 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE) / 1e6
+                return min(upper, self.max)
+
+        return self.max
+
+    def summary(self):
+        """
+        Summary of the histogram, in milliseconds
+        """
+
+        return {
+            'count': self.count,
+            'mean_ms': 1000 * self.total / max(1, self.count),
+            'p50_ms': 1000 * self.percentile(50),
+            'p99_ms': 1000 * self.percentile(99),
+            'max_ms': 1000 * self.max,
+        }
+
+class Stats:
+    """
+    Collection of histograms indexed by name, eg: 'update.PosiStrobe'
+    """
+
+    def __init__(self):
+        self.hists = {}
+
+        # Functions returning extra stats to publish, indexed by name
+        self.sources = {}
+
+        # Functions returning timing summaries kept elsewhere (eg: in
+        # another process), published along with our own timings
+        self.timing_sources = []
+
+        self.publisher = None
+
+    def record(self, key, seconds):
+        hist = self.hists.get(key)
+        if hist is None:
+            hist = self.hists[key] = Histogram()
+        hist.record(seconds)
+
+    def add_source(self, name, fn):
+        """
+        Publish the dict returned by some function along with the timings
+        """
+        self.sources[name] = fn
+
+    def add_timing_source(self, fn):
+        """
+        Publish the timing summaries returned by some function along
+        with the timings, eg: the timings of a worker process
+        """
+        self.timing_sources.append(fn)
+
+    def snapshot(self):
+        timings = {key: hist.summary() for key, hist in list(self.hists.items())}
+        for fn in list(self.timing_sources):
+            timings.update(fn())
+
+        return {
+            'time': time.time(),
+            'timings': timings,
+            'sources': {name: fn() for name, fn in list(self.sources.items())},
+        }
+
+    def reset(self):
+        self.hists = {}
+
+    def publish(self, dest):
+        """
+        Publish a snapshot of the stats. The destination is either a file
+        path or a Unix datagram socket path prefixed with 'unix:'.
+        """
+
+        data = json.dumps(self.snapshot()).encode()
+
+        if dest.startswith('unix:'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                sock.sendto(data, dest[len('unix:'):])
+            except OSError:
+                # Nobody is listening
+                pass
+            finally:
+                sock.close()
+        else:
+            tmp_path = dest + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, dest)
+
+    def start_publisher(self, dest, interval=2):
+        """
+        Publish the stats periodically from a background thread
+        """
+
+        def publish_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.publish(dest)
+                except OSError as e:
+                    print('Failed to publish stats:', e, file=sys.stderr)
+
+        self.publisher = threading.Thread(target=publish_loop, daemon=True)
+        self.publisher.start()
+
+# Stats shared by the whole process
+stats = Stats()
+
+def print_snapshot(snapshot):
+    print('\x1b[2J\x1b[H', end='')
+    print('{:<32} {:>8} {:>9} {:>9} {:>9} {:>9}'.format(
+        'timing', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'
+    ))
+    for key, s in sorted(snapshot['timings'].items()):
+        print('{:<32} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            key, s['count'], s['mean_ms'], s['p50_ms'], s['p99_ms'], s['max_ms']
+        ))
+    for name, values in sorted(snapshot['sources'].items()):
+        print()
+        print(name)
+        for key, value in values.items():
+            print('  {:<30} {}'.format(key, value))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='watch the stats published by main.py')
+    parser.add_argument('dest', help="stats file path, or 'unix:' followed by a socket path")
+    parser.add_argument('--interval', type=float, default=1, help='refresh interval when watching a file (seconds)')
+    args = parser.parse_args()
+
+    if args.dest.startswith('unix:'):
+        path = args.dest[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        while True:
+            print_snapshot(json.loads(sock.recv(1 << 20)))
+    else:
+        while True:
+            if os.path.exists(args.dest):
+                with open(args.dest) as f:
+                    print_snapshot(json.load(f))
+            time.sleep(args.interval)
@@ -1,21 +1,53 @@
+import os
+import json
 import math
+import hashlib
+import zipfile
 import numpy as np
-from util import rot_matrix
+from util import rot_matrix, load_npz
+from spatial import SpatialGrid
+
+# Bump this when the compiled structure format changes
+COMPILED_VERSION = 3
+
+# Arrays built by finalize, which are stored in the compiled structure
+# files, so that loading a structure doesn't rebuild them
+FINALIZED_ARRAYS = [
+    'edge_starts',
+    'edge_lengths',
+    'vert_poss',
+    'edge_verts',
+    'edge_dirs',
+    'edge_lens',
+    'vert_edge_starts',
+    'vert_edges',
+    'vert_edge_ends',
+    'led_edges',
+    'led_fracs',
+    'led_vert_dists',
+    'poss',
+]
+
+# Directory holding the structure files
+STRUCTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'structures')
 
 class Vertex:
     """
     Point where multiple edges meet/connect
     """
 
-    def __init__(self, pos):
+    def __init__(self, pos, idx=0):
         # Position of this vertex in 3D space
         self.pos = np.array(pos, dtype=np.float32)
 
-        # Edges associated with this vertex
+        # Index of this vertex (assigned by the structure)
+        self.idx = idx
+
+        # Edges associated with this vertex (populated by finalize)
         self.edges = []
 
 class Edge:
-    def __init__(self, start, end, edge_idx, num_leds=60):
+    def __init__(self, start, end, edge_idx, led_start, num_leds=60):
         # Start and end vertices
         self.start = start
         self.end = end
@@ -23,13 +55,15 @@ class Edge:
         # Number of LEDs among this edge
         self.num_leds = num_leds
 
-        # TODO:
-        # Start and end indices in a global LED matrix?
-        # Or do we just want to assign each edge an index
-
         # Index of this edge (assigned by the structure)
         self.edge_idx = edge_idx
 
+        # Index of the first LED of this edge in the flat LED buffers
+        self.led_start = led_start
+
+        # Slice of the LEDs of this edge in the flat LED buffers
+        self.leds = slice(led_start, led_start + num_leds)
+
 class Structure:
     """
     Define the topology and spatial positioning of a 3D shape/structure
@@ -37,8 +71,8 @@ class Structure:
     """
 
     def __init__(self, leds_per_edge=60):
-        # Each edge is assumed to have the same number of LEDs
-        self.leds_per_edge = 60
+        # Default number of LEDs per edge
+        self.leds_per_edge = leds_per_edge
 
         # List of vertices
         self.verts = []
@@ -49,12 +83,40 @@ class Structure:
         # Total number of LEDs in the structure
         self.num_leds = 0
 
-        # NumPy array, RGB color of each pixel (num_edges, leds_per_edge, 3)
+        # NumPy array, RGB color of each pixel (num_leds, 3)
+        # The LEDs are in wiring order, edge after edge
         self.pixels = None
 
-        # NumPy array, XYZ position of every LED (num_edges, leds_per_edge, 3)
+        # NumPy array, XYZ position of every LED (num_leds, 3)
         self.poss = None
 
+        # Spatial index over the LED positions, built by finalize
+        self.index = None
+
+        # NumPy arrays, index of the first LED and number of LEDs of each edge
+        self.edge_starts = None
+        self.edge_lengths = None
+
+        # Topology arrays, built by finalize:
+        # edge_verts: (num_edges, 2) start and end vertex of each edge
+        # edge_dirs: (num_edges, 3) unit vector from start to end vertex
+        # edge_lens: (num_edges,) physical length of each edge
+        # vert_edge_starts: (num_verts + 1,) offsets into vert_edges
+        # vert_edges: edges incident to each vertex (CSR, 2 * num_edges)
+        # vert_edge_ends: 0 if the incident edge starts at the vertex, 1 if it ends there
+        # led_edges: (num_leds,) edge of each LED
+        # led_fracs: (num_leds,) position of each LED along its edge, from 0 to 1
+        # led_vert_dists: (num_leds, 2) distance from each LED to its edge's start and end vertex
+        self.edge_verts = None
+        self.edge_dirs = None
+        self.edge_lens = None
+        self.vert_edge_starts = None
+        self.vert_edges = None
+        self.vert_edge_ends = None
+        self.led_edges = None
+        self.led_fracs = None
+        self.led_vert_dists = None
+
     @property
     def num_edges(self):
         return len(self.edges)
@@ -64,13 +126,13 @@ class Structure:
         Add a new vertex to the structure
         """
 
-        v = Vertex(pos)
+        v = Vertex(pos, len(self.verts))
         self.verts.append(v)
 
         # Return the new vertex
         return v
 
-    def add_edge(self, idx0, idx1):
+    def add_edge(self, idx0, idx1, num_leds=None):
         """
         Add a new edge to the structure
         """
@@ -82,7 +144,8 @@ class Structure:
             start=self.verts[idx0],
             end=self.verts[idx1],
             edge_idx=len(self.edges),
-            num_leds=self.leds_per_edge
+            led_start=self.num_leds,
+            num_leds=self.leds_per_edge if num_leds is None else num_leds
         )
 
         self.edges.append(edge)
@@ -113,65 +176,186 @@ class Structure:
         z_sorted = sorted(self.verts, key = lambda v: v.pos[2])
         return x_sorted[0].pos[0], x_sorted[-1].pos[0], y_sorted[0].pos[1], y_sorted[-1].pos[1], z_sorted[0].pos[2], z_sorted[-1].pos[2]
 
-    def finalize(self):
+    def edge_view(self, buf, edge_idx):
+        """
+        Get a view of the LEDs of one edge in a per-LED buffer,
+        eg: struct.pixels or an animation's output buffer
+        """
+        return buf[self.edges[edge_idx].leds]
+
+    def finalize(self, arrays=None):
         """
-        Called once all vertices and edges are added
+        Called once all vertices and edges are added.
+        The finalized arrays can be passed in, eg: from a cache.
         """
 
+        if arrays is not None:
+            for name in FINALIZED_ARRAYS:
+                setattr(self, name, arrays[name])
+        else:
+            self.edge_starts = np.array([e.led_start for e in self.edges], dtype=np.int32)
+            self.edge_lengths = np.array([e.num_leds for e in self.edges], dtype=np.int32)
+            self.build_topology()
+
+            # Compute the position of each LED, interpolating
+            # between the start and end vertex of its edge
+            f = self.led_fracs[:, np.newaxis]
+            p0 = self.vert_poss[self.edge_verts[self.led_edges, 0]]
+            p1 = self.vert_poss[self.edge_verts[self.led_edges, 1]]
+            self.poss = (1 - f) * p0 + f * p1
+
+        for vert in self.verts:
+            start, end = self.vert_edge_starts[vert.idx:vert.idx+2]
+            vert.edges = [self.edges[i] for i in self.vert_edges[start:end]]
+
         # Allocate an array for the LED RGB pixels
-        self.pixels = np.zeros(
-            shape=(len(self.edges), self.leds_per_edge, 3),
-            dtype=np.float32
-        )
+        self.pixels = np.zeros(shape=(self.num_leds, 3), dtype=np.float32)
 
-        # Allocate an array for the LED positions in 3D space
-        self.poss = np.zeros(
-            shape=(self.num_edges, self.leds_per_edge, 3),
-            dtype=np.float32
+        self.index = SpatialGrid(self.poss)
+
+    def build_topology(self):
+        """
+        Build the vertex/edge incidence and per-LED topology arrays,
+        so that graph traversals can be done with vectorized gathers
+        """
+
+        num_verts = len(self.verts)
+        num_edges = self.num_edges
+
+        self.vert_poss = np.array([v.pos for v in self.verts], dtype=np.float32).reshape(-1, 3)
+
+        self.edge_verts = np.array(
+            [[e.start.idx, e.end.idx] for e in self.edges],
+            dtype=np.int32
+        ).reshape(-1, 2)
+
+        delta = self.vert_poss[self.edge_verts[:, 1]] - self.vert_poss[self.edge_verts[:, 0]]
+        self.edge_lens = np.linalg.norm(delta, axis=-1).astype(np.float32)
+        self.edge_dirs = delta / np.maximum(self.edge_lens, 1e-9)[:, np.newaxis]
+
+        # Vertex to edge incidence, in compressed sparse row format
+        incident_verts = self.edge_verts.T.reshape(-1)
+        incident_edges = np.tile(np.arange(num_edges, dtype=np.int32), 2)
+        incident_ends = np.repeat(np.arange(2, dtype=np.int8), num_edges)
+        order = np.argsort(incident_verts, kind='stable')
+        self.vert_edges = incident_edges[order]
+        self.vert_edge_ends = incident_ends[order]
+        counts = np.bincount(incident_verts, minlength=num_verts)
+        self.vert_edge_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+
+        # Per-LED edge index and position along the edge
+        # Note: led_edges uses the native index type so that gathers
+        # with it don't need to convert the indices first
+        self.led_edges = np.repeat(np.arange(num_edges, dtype=np.intp), self.edge_lengths)
+        led_idx = np.arange(self.num_leds) - self.edge_starts[self.led_edges]
+        self.led_fracs = ((led_idx + 0.5) / self.edge_lengths[self.led_edges]).astype(np.float32)
+
+        lens = self.edge_lens[self.led_edges]
+        self.led_vert_dists = np.stack(
+            [self.led_fracs * lens, (1 - self.led_fracs) * lens],
+            axis=-1
         )
 
-        # Compute the position of each LED
-        for edge_idx, edge in enumerate(self.edges):
-            p0 = edge.start.pos
-            p1 = edge.end.pos
-            for led_idx in range(edge.num_leds):
-                f = (led_idx + 0.5) / edge.num_leds
-                p = (1 - f) * p0 + f * p1
-                self.poss[edge_idx, led_idx, :] = p
-
-cube = Structure()
-
-# Bottom face (y=-1)
-cube.add_vertex([-1,-1,-1]) # 0
-cube.add_vertex([ 1,-1,-1]) # 1
-cube.add_vertex([ 1,-1, 1]) # 2
-cube.add_vertex([-1,-1, 1]) # 3
-
-# Top face (y=1)
-cube.add_vertex([-1, 1,-1]) # 4
-cube.add_vertex([ 1, 1,-1]) # 5
-cube.add_vertex([ 1, 1, 1]) # 6
-cube.add_vertex([-1, 1, 1]) # 7
-
-# Bottom face edges
-cube.add_edge(0, 1)
-cube.add_edge(1, 2)
-cube.add_edge(2, 3)
-cube.add_edge(3, 0)
-
-# Top face edges
-cube.add_edge(4, 5)
-cube.add_edge(5, 6)
-cube.add_edge(6, 7)
-cube.add_edge(7, 4)
-
-# Connect bottom to top
-cube.add_edge(4, 0)
-cube.add_edge(1, 5)
-cube.add_edge(6, 2)
-cube.add_edge(3, 7)
-
-cube.scale(0.5)
-#cube.rotate([1, 0, 0], math.pi / 4)
-#cube.rotate([0, 1, 0], math.pi / 4)
-cube.finalize()
+def compile_structure(spec):
+    """
+    Build a structure from a parsed structure file
+    """
+
+    struct = Structure(spec.get('leds_per_edge', 60))
+
+    for pos in spec['vertices']:
+        struct.add_vertex(pos)
+
+    edges = spec['edges']
+
+    # Edges are listed in wiring order unless an explicit order is given
+    if 'wiring' in spec:
+        edges = [edges[edge_idx] for edge_idx in spec['wiring']]
+
+    for edge in edges:
+        struct.add_edge(edge[0], edge[1], edge[2] if len(edge) > 2 else None)
+
+    struct.scale(spec.get('scale', 1))
+
+    for axis, angle in spec.get('rotate', []):
+        struct.rotate(axis, math.radians(angle))
+
+    struct.finalize()
+    return struct
+
+def load(path):
+    """
+    Load a structure file. The structure is compiled into a .npz file
+    next to it, which is memory-mapped on later loads, as long as the
+    structure file doesn't change.
+
+    Structure files are JSON, with the following fields:
+    - vertices: list of [x, y, z] positions
+    - edges: list of [start, end] vertex indices, in wiring order,
+      optionally followed by the number of LEDs on the edge
+    - leds_per_edge: default number of LEDs per edge (default 60)
+    - wiring: optional order of the edges along the LED strips
+    - scale: optional scale factor for the vertex positions
+    - rotate: optional list of [[x, y, z], degrees] rotations
+    """
+
+    with open(path, 'rb') as f:
+        src = f.read()
+
+    key = hashlib.sha1(src + str(COMPILED_VERSION).encode()).hexdigest()
+    cache_path = os.path.splitext(path)[0] + '.npz'
+
+    try:
+        cached = load_npz(cache_path)
+        if str(cached['key']) == key:
+            return from_arrays(cached)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        # Missing, stale or corrupt cache, which is rebuilt below
+        pass
+
+    struct = compile_structure(json.loads(src))
+
+    try:
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, key=np.array(key), **to_arrays(struct))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # The structure works fine without a cache
+        pass
+
+    return struct
+
+def to_arrays(struct):
+    """
+    Flatten a structure into arrays
+    """
+
+    arrays = {name: getattr(struct, name) for name in FINALIZED_ARRAYS}
+    arrays['leds_per_edge'] = np.array(struct.leds_per_edge)
+    return arrays
+
+def from_arrays(arrays):
+    """
+    Rebuild a structure from its flattened arrays. The vertex and edge
+    objects are recreated, but the topology arrays are used as is, so
+    with memory-mapped arrays nothing per LED is computed or copied.
+    """
+
+    struct = Structure(int(arrays['leds_per_edge']))
+
+    struct.verts = [Vertex(pos, idx) for idx, pos in enumerate(arrays['vert_poss'])]
+
+    edge_starts = arrays['edge_starts'].tolist()
+    edge_lengths = arrays['edge_lengths'].tolist()
+    edge_verts = arrays['edge_verts'].tolist()
+    struct.edges = [
+        Edge(struct.verts[idx0], struct.verts[idx1], edge_idx, led_start, num_leds)
+        for edge_idx, ((idx0, idx1), led_start, num_leds)
+        in enumerate(zip(edge_verts, edge_starts, edge_lengths))
+    ]
+    struct.num_leds = sum(edge_lengths)
+
+    struct.finalize(arrays)
+    return struct
+
+cube = load(os.path.join(STRUCTURES_DIR, 'cube.json'))
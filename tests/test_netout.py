@@ -0,0 +1,85 @@
+import time
+import numpy as np
+from netout import DdpSink, DdpReceiver
+from output import Output, Packer
+
+NUM_LEDS = 1000
+
+def receive(receiver):
+    """
+    Receive the packets already sent, returns the number of frames
+    """
+    frames = []
+    receiver.receive(frames.append, 0.05)
+    return len(frames)
+
+def test_delta_matches_full():
+    full_receiver = DdpReceiver(NUM_LEDS, 0)
+    delta_receiver = DdpReceiver(NUM_LEDS, 0)
+    full_sink = DdpSink('127.0.0.1', NUM_LEDS, full_receiver.port)
+    delta_sink = DdpSink('127.0.0.1', NUM_LEDS, delta_receiver.port, delta=True)
+
+    # Over a second between frames would refresh with a keyframe
+    delta_sink.encoder.refresh_interval = 60
+
+    try:
+        packed = np.random.randint(0, 256, size=(NUM_LEDS, 3)).astype(np.uint8)
+        frames = [packed.copy()]
+
+        # A few spans changing, so delta frames are sent
+        for i in range(5):
+            packed[np.random.randint(0, NUM_LEDS, size=20)] = np.random.randint(0, 256, size=3)
+            frames.append(packed.copy())
+
+        # Most LEDs changing, then nothing changing
+        packed[:800] = 255 - packed[:800]
+        frames.append(packed.copy())
+        frames.append(packed.copy())
+
+        for packed in frames:
+            full_sink.write(packed)
+            delta_sink.write(packed)
+            receive(full_receiver)
+            receive(delta_receiver)
+
+            assert np.array_equal(full_receiver.frame, packed.reshape(-1))
+            assert np.array_equal(delta_receiver.frame, full_receiver.frame)
+
+        assert delta_sink.num_bytes < full_sink.num_bytes
+        assert delta_receiver.num_gaps == 0
+    finally:
+        full_sink.close()
+        delta_sink.close()
+        full_receiver.close()
+        delta_receiver.close()
+
+def test_still_frame_refresh():
+    receiver = DdpReceiver(NUM_LEDS, 0)
+    sink = DdpSink('127.0.0.1', NUM_LEDS, receiver.port, delta=True)
+    output = Output(sink, Packer(NUM_LEDS, order=sink.order))
+
+    try:
+        pixels = np.random.uniform(0, 1, size=(NUM_LEDS, 3)).astype(np.float32)
+        assert output.push(pixels, 1)
+        assert receive(receiver) == 1
+        frame = receiver.frame.copy()
+
+        # The same generation is skipped, with no refresh due yet
+        assert not output.push(pixels, 1)
+        assert receive(receiver) == 0
+
+        # Lost packets leave the controller with a wrong frame, the
+        # refresh on the next still frame sends it all again
+        receiver.frame[:] = 0
+        sink.encoder.refresh_interval = 0.05
+        time.sleep(0.1)
+
+        num_packets = receiver.num_packets
+        assert not output.push(pixels, 1)
+        assert receive(receiver) == 1
+        assert receiver.num_packets - num_packets == sink.num_packets
+        assert np.array_equal(receiver.frame, frame)
+        assert output.num_skipped == 2
+    finally:
+        sink.close()
+        receiver.close()
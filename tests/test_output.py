@@ -0,0 +1,120 @@
+import threading
+import numpy as np
+import structure
+from output import Packer, MockStrip, ShardedOutput
+
+class RecordingSink:
+    """
+    Sink keeping a copy of the last frame written, in RGB order
+    """
+
+    def __init__(self, num_leds):
+        self.num_leds = num_leds
+        self.order = 'RGB'
+        self.bytes = None
+
+    def write(self, packed):
+        self.bytes = packed.copy()
+
+    def close(self):
+        pass
+
+class FailingSink:
+    """
+    Sink raising on every write, like a buggy driver
+    """
+
+    def __init__(self, num_leds):
+        self.num_leds = num_leds
+        self.order = 'RGB'
+
+    def write(self, packed):
+        raise RuntimeError('sink failed')
+
+    def close(self):
+        pass
+
+def edge_leds(struct, first_edge, end_edge):
+    start = struct.edge_starts[first_edge]
+    end = struct.edge_starts[end_edge - 1] + struct.edge_lengths[end_edge - 1]
+    return slice(int(start), int(end))
+
+def push_frames(output, frames, first_generation=0, timeout=5):
+    """
+    Push the frames from another thread, so a deadlock fails
+    the test instead of hanging it
+    """
+
+    def run():
+        for generation, pixels in enumerate(frames):
+            output.push(pixels, first_generation + generation)
+        output.wait()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive()
+
+def test_sharded_matches_packer(tmp_path):
+    struct = structure.cube
+    grb_leds = edge_leds(struct, 0, 5)
+    rgb_leds = edge_leds(struct, 5, 12)
+
+    grb_sink = MockStrip(str(tmp_path / 'strip'), grb_leds.stop - grb_leds.start)
+    rgb_sink = RecordingSink(rgb_leds.stop - rgb_leds.start)
+
+    output = ShardedOutput(struct, [
+        ('grb', grb_sink, 0, 5),
+        ('rgb', rgb_sink, 5, 12),
+    ], gamma=2.2, brightness=0.8)
+
+    grb_packer = Packer(struct.num_leds, 2.2, 0.8, 'GRB')
+    rgb_packer = Packer(struct.num_leds, 2.2, 0.8, 'RGB')
+
+    try:
+        for i in range(3):
+            pixels = np.random.uniform(-0.1, 1.1, size=(struct.num_leds, 3)).astype(np.float32)
+            push_frames(output, [pixels], i)
+
+            # Each shard gets the bytes a single packer gives for its
+            # range of edges, in its own channel order
+            assert np.array_equal(grb_sink.bytes, grb_packer.pack(pixels)[grb_leds])
+            assert np.array_equal(rgb_sink.bytes, rgb_packer.pack(pixels)[rgb_leds])
+    finally:
+        output.close()
+
+def test_sharded_sink_error(tmp_path, capsys):
+    struct = structure.cube
+    good_leds = edge_leds(struct, 0, 6)
+    bad_leds = edge_leds(struct, 6, 12)
+
+    good_sink = MockStrip(str(tmp_path / 'strip'), good_leds.stop - good_leds.start)
+    bad_sink = FailingSink(bad_leds.stop - bad_leds.start)
+
+    output = ShardedOutput(struct, [
+        ('good', good_sink, 0, 6),
+        ('bad', bad_sink, 6, 12),
+    ])
+
+    try:
+        frames = [
+            np.full((struct.num_leds, 3), (i + 1) / 10, dtype=np.float32)
+            for i in range(5)
+        ]
+        push_frames(output, frames)
+
+        # The failing sink doesn't stop the frames, nor the other sink
+        counters = output.stats()
+        assert counters['writes'] == 5
+        assert counters['bad']['errors'] == 5
+        assert counters['bad']['writes'] == 0
+        assert counters['good']['errors'] == 0
+        assert counters['good']['writes'] == 5
+        assert good_sink.num_frames == 5
+
+        packer = Packer(struct.num_leds, 2.2, 1.0, 'GRB')
+        assert np.array_equal(good_sink.bytes, packer.pack(frames[-1])[good_leds])
+    finally:
+        output.close()
+
+    assert 'sink failed' in capsys.readouterr().err
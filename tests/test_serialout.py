@@ -0,0 +1,107 @@
+import os
+import time
+import numpy as np
+from serialout import SerialSink, open_pty, encode_frame, cobs_encode, cobs_decode
+
+def receive_frames(receiver, sink, num_frames, timeout=5):
+    """
+    Receive until num_frames were decoded, finishing the sink
+    writes in between, returns the list of (seq, rgb)
+    """
+
+    frames = []
+    on_frame = lambda seq, rgb: frames.append((seq, rgb.copy()))
+    deadline = time.monotonic() + timeout
+
+    while receiver.num_frames < num_frames and time.monotonic() < deadline:
+        if sink is not None:
+            sink.poll()
+        receiver.receive(on_frame, 0.01)
+
+    return frames
+
+def test_cobs_long_run():
+    # Runs longer than a block, with and without zeros around them
+    for data in [
+        np.arange(600) % 255 + 1,
+        np.concatenate([[0], np.full(254, 7), [0], np.full(508, 9)]),
+        np.zeros(3),
+        np.full(254, 1),
+    ]:
+        data = np.asarray(data, dtype=np.uint8)
+        encoded = cobs_encode(data)
+        assert 0 not in encoded
+        assert cobs_decode(encoded.tobytes()) == data.tobytes()
+
+def test_round_trip():
+    receiver, path = open_pty()
+    sink = SerialSink(path, 200)
+
+    try:
+        # 600 non-zero bytes in a row, more than a COBS block
+        frames = [
+            (np.arange(600) % 255 + 1).astype(np.uint8).reshape(-1, 3),
+            np.zeros((200, 3), dtype=np.uint8),
+            np.random.randint(0, 256, size=(200, 3)).astype(np.uint8),
+        ]
+
+        for packed in frames:
+            sink.write(packed)
+            received = receive_frames(receiver, sink, receiver.num_frames + 1)
+            assert len(received) == 1
+            assert np.array_equal(received[0][1], packed)
+
+        assert receiver.num_corrupted == 0
+        assert receiver.num_missing == 0
+        assert sink.num_dropped == 0
+    finally:
+        sink.close()
+
+def test_corrupted_packet():
+    receiver, path = open_pty()
+    sink = SerialSink(path, 200)
+
+    try:
+        packed = np.random.randint(1, 256, size=(200, 3)).astype(np.uint8)
+        packet = bytearray(encode_frame(packed, 1))
+
+        # Flip bits of a data byte, without making it a delimiter
+        pos = 100
+        packet[pos] ^= 0x01 if packet[pos] != 0x01 else 0x02
+        os.write(receiver.slave_fd, bytes(packet))
+
+        # A good frame after it is still received
+        sink.write(packed)
+        received = receive_frames(receiver, sink, 1)
+
+        assert receiver.num_corrupted == 1
+        assert len(received) == 1
+        assert np.array_equal(received[0][1], packed)
+    finally:
+        sink.close()
+
+def test_back_pressure():
+    receiver, path = open_pty()
+    num_leds = 8640
+    sink = SerialSink(path, num_leds)
+
+    try:
+        # Frames much larger than the pty buffer, nothing read
+        # so the link can't keep up
+        for i in range(10):
+            packed = np.full((num_leds, 3), i + 1, dtype=np.uint8)
+            sink.write(packed)
+
+        assert sink.num_dropped > 0
+
+        # Draining the link delivers the frames not dropped, ending
+        # with the latest one, and the gaps show in the sequence numbers
+        num_sent = 10 - sink.num_dropped
+        received = receive_frames(receiver, sink, num_sent)
+
+        assert len(received) == num_sent
+        assert np.all(received[-1][1] == 10)
+        assert receiver.num_corrupted == 0
+        assert receiver.num_missing == sink.num_dropped
+    finally:
+        sink.close()
@@ -1,4 +1,5 @@
 import math
+import zipfile
 import numpy as np
 
 def rot_matrix(axis, theta):
@@ -18,3 +19,45 @@ def rot_matrix(axis, theta):
         [2 * (bc - ad), aa + cc - bb - dd, 2 * (cd + ab)],
         [2 * (bd + ac), 2 * (cd - ab), aa + dd - bb - cc]
     ])
+
+def load_npz(path):
+    """
+    Load the arrays of an uncompressed .npz file as read-only memory maps.
+    Note: np.load ignores mmap_mode for .npz files, so we locate each
+    array inside the zip archive ourselves.
+    """
+
+    arrays = {}
+
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('compressed npz member: ' + info.filename)
+
+            # Skip the local file header to find the start of the .npy data
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+
+            name = info.filename[:-len('.npy')]
+
+            if dtype.hasobject or 0 in shape:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+                continue
+
+            arrays[name] = np.memmap(
+                path,
+                dtype=dtype,
+                mode='r',
+                offset=f.tell(),
+                shape=shape,
+                order='F' if fortran else 'C'
+            )
+
+    return arrays